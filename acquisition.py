@@ -0,0 +1,65 @@
+import ctypes
+import time
+import numpy as np
+
+class RecordReader():
+    # Read records of the enabled channels straight into preallocated
+    # float32 buffers of shape (len(ch), record_length), so that steady-state
+    # acquisition does not allocate new arrays for every record.
+    #  - "direct": the device object has get_data_into (simulator)
+    #  - "ctypes": libtiepie's ScpGetData is called with pointers to the
+    #    buffers, as Oscilloscope.get_data does with arrays of its own
+    #  - "copy": fall back on get_data and copy the result
+    def __init__(self, scp, lib, ch):
+        self.scp = scp
+        self.lib = lib
+        self.ch = ch
+        self.nchan_dev = len(scp.channels)
+        self.pointers = {}
+        self.api = None
+        # time spent copying the arrays of get_data ("copy" mode)
+        self.copy_time = 0.0
+        if hasattr(scp, "get_data_into"):
+            self.mode = "direct"
+        else:
+            self.mode = "copy"
+            try:
+                from libtiepie.api import api
+                if hasattr(scp, "_handle") and hasattr(api, "ScpGetData") and hasattr(api, "HlpPointerArrayNew"):
+                    self.api = api
+                    self.mode = "ctypes"
+            except ImportError:
+                pass
+
+    def pointer_array(self, buf):
+        # one pointer array per buffer, built once and reused
+        key = buf.ctypes.data
+        if not key in self.pointers:
+            ptrs = self.api.HlpPointerArrayNew(self.nchan_dev)
+            for k, c in enumerate(self.ch):
+                self.api.HlpPointerArraySet(ptrs, c, ctypes.cast(buf[k].ctypes.data, ctypes.c_void_p))
+            self.pointers[key] = ptrs
+        return self.pointers[key]
+
+    def read_into(self, buf):
+        # returns the number of samples read per channel
+        count = buf.shape[1]
+        if self.mode=="direct":
+            return self.scp.get_data_into(buf, self.ch)
+        if self.mode=="ctypes":
+            n = self.api.ScpGetData(self.scp._handle, self.pointer_array(buf), self.nchan_dev, 0, count)
+            self.lib.library.check_last_status_raise_on_error()
+            return int(n)
+        data = self.scp.get_data()
+        t0 = time.perf_counter()
+        n = min(count, len(data[self.ch[0]]))
+        for k, c in enumerate(self.ch):
+            buf[k, :n] = np.asarray(data[c])[:n]
+        self.copy_time = self.copy_time+time.perf_counter()-t0
+        return n
+
+    def close(self):
+        if self.api is not None:
+            for ptrs in self.pointers.values():
+                self.api.HlpPointerArrayDelete(ptrs)
+        self.pointers = {}
@@ -0,0 +1,189 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from engine import StreamEngine, get_backend
+
+# Throughput benchmark of the file writing path, without hardware. Synthetic
+# records are written through StreamEngine.write_chunk (scaling, rotation and
+# write_data), and the time spent per record gives the throughput, latency
+# percentiles and the highest sampling frequency each format can sustain.
+#
+#   python benchmark.py --formats hdf5 bin --channels 1 4 16 --record-lengths 10000 100000
+#   python benchmark.py --realtime --formats hdf5-append
+#   python benchmark.py --formats csv --off-grid
+
+# settings of the engine for each benchmarked output format
+FORMATS = {"hdf5": {"fileext": ".hdf5", "h5layout": "chunks"},
+           "hdf5-append": {"fileext": ".hdf5", "h5layout": "append"},
+           "hdf5-append-gzip": {"fileext": ".hdf5", "h5layout": "append", "h5compression": "gzip"},
+           "hdf5-append-lzf": {"fileext": ".hdf5", "h5layout": "append", "h5compression": "lzf"},
+           "hdf5-counts": {"fileext": ".hdf5", "h5layout": "chunks", "storage": "counts"},
+           "hdf5-append-counts": {"fileext": ".hdf5", "h5layout": "append", "storage": "counts"},
+           "csv": {"fileext": ".csv"},
+           "tsv": {"fileext": ".tsv"},
+           "bin": {"fileext": ".bin"},
+           "bin-counts": {"fileext": ".bin", "storage": "counts"}}
+
+def make_engine(fmt, nchan, reclength, sample_rate, rotation, folder):
+    backend = get_backend("simulator")
+    backend.configure(n_instr=4)
+    engine = StreamEngine(backend)
+    engine.open_dev()
+    engine.foldername = folder
+    engine.filename = "bench"
+    for key, val in FORMATS[fmt].items():
+        setattr(engine, key, val)
+    engine.chan_enabled = [1 if c<nchan else 0 for c in range(16)]
+    engine.chan_ranges = [8.0]*16
+    engine.freq = sample_rate
+    engine.res = 16
+    engine.reclength = reclength
+    if rotation>0:
+        engine.newfileperiod = rotation
+        engine.newfileunit = "s"
+    else:
+        engine.newfileunit = "infty"
+    return engine
+
+def synthetic_records(nchan, reclength, resolution=16, rng=8.0, npool=4, off_grid=False):
+    lsb = 2*rng/2**resolution
+    gen = np.random.default_rng(0)
+    x = gen.standard_normal((npool, nchan, reclength))*0.1*rng
+    x = np.round(x/lsb)*lsb
+    if off_grid:
+        # samples of a calibrated device are no longer multiples of the step
+        # of the ADC, as if a gain and offset correction had been applied
+        x = x*1.0003+1.1e-3
+    return x.astype(np.float32)
+
+def folder_size(folder):
+    size = 0
+    for name in os.listdir(folder):
+        size = size+os.path.getsize(os.path.join(folder, name))
+    return size
+
+def bench_write(fmt, nchan, reclength, sample_rate, rotation, nrec, folder, off_grid=False):
+    # write nrec records as fast as possible; the time stamps given to the
+    # writer follow the sampling frequency, so that rotation happens as often
+    # as it would in a real run
+    engine = make_engine(fmt, nchan, reclength, sample_rate, rotation, folder)
+    engine.arm_dev()
+    okchans = engine.chan_indices()
+    records = synthetic_records(nchan, reclength, off_grid=off_grid)
+    t_start = 0.0
+    engine.init_output(okchans, start=t_start)
+    lat = np.zeros(nrec)
+    t0 = time.perf_counter()
+    for count in range(nrec):
+        stamp = t_start+count*reclength/engine.scp.sample_rate
+        t = time.perf_counter()
+        engine.write_chunk(records[count%len(records)], count, stamp)
+        lat[count] = time.perf_counter()-t
+    engine.close_output()
+    total = time.perf_counter()-t0
+
+    nbytes = 4.0*nchan*reclength*nrec
+    return {"format": fmt, "off_grid": off_grid, "channels": nchan, "record_length": reclength,
+            "sample_rate": engine.scp.sample_rate, "rotation": rotation, "records": nrec,
+            "files": engine.fcount+1,
+            "MB/s": nbytes/total/1e6,
+            "disk MB/s": folder_size(folder)/total/1e6,
+            "p50 ms": 1e3*np.percentile(lat, 50),
+            "p90 ms": 1e3*np.percentile(lat, 90),
+            "p99 ms": 1e3*np.percentile(lat, 99),
+            "max ms": 1e3*lat.max(),
+            # with a write queue, the mean write time sets the sustainable
+            # rate; without one, every record must be written within its duration
+            "max fs": reclength/np.mean(lat),
+            "max fs (p99)": reclength/np.percentile(lat, 99)}
+
+def bench_realtime(fmt, nchan, reclength, rotation, duration, folder, rates):
+    # stream the simulator through the full engine at increasing sampling
+    # frequencies; the highest one without overflow or dropped records is kept
+    best = 0.0
+    for fs in rates:
+        engine = make_engine(fmt, nchan, reclength, fs, rotation, folder)
+        engine.queuepolicy = "drop"
+        engine.start_streaming()
+        time.sleep(duration)
+        engine.stop_streaming(wait=True)
+        cnt = engine.pipe.counters()
+        ok = (not engine.scp.is_data_overflow) and cnt["dropped"]==0
+        print("  ", fmt, nchan, "ch at", fs, "Hz:", "ok" if ok else "overflow/dropped")
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        if not ok:
+            break
+        best = fs
+    return best
+
+def print_table(results):
+    keys = ["format", "off_grid", "channels", "record_length", "sample_rate", "rotation", "files",
+            "MB/s", "disk MB/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "max fs", "max fs (p99)"]
+    print(" | ".join(keys))
+    for res in results:
+        row = []
+        for key in keys:
+            val = res[key]
+            if isinstance(val, float):
+                row.append("%.4g" % val)
+            else:
+                row.append(str(val))
+        print(" | ".join(row))
+
+def save_table(results, fname):
+    keys = list(results[0].keys())
+    with open(fname, 'w') as f:
+        f.write(";".join(keys)+"\n")
+        for res in results:
+            f.write(";".join([str(res[key]) for key in keys])+"\n")
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the streaming write path with synthetic records.")
+    parser.add_argument("--formats", nargs="+", default=["hdf5", "hdf5-append", "csv", "bin"], choices=list(FORMATS.keys()))
+    parser.add_argument("--channels", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--record-lengths", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--sample-rates", nargs="+", type=float, default=[1e6])
+    parser.add_argument("--rotation", nargs="+", type=float, default=[0], help="new file period(s) in seconds, 0 for none")
+    parser.add_argument("--records", type=int, default=50, help="records written per case")
+    parser.add_argument("--folder", help="where to write the test files (default: temporary folder)")
+    parser.add_argument("--output", help="save the results as a csv table")
+    parser.add_argument("--realtime", action="store_true", help="also find the highest sampling frequency streamed without overflow")
+    parser.add_argument("--off-grid", action="store_true", help="write samples that are not multiples of the ADC step")
+    parser.add_argument("--duration", type=float, default=2.0, help="duration of each realtime run (s)")
+    opts = parser.parse_args(args)
+
+    root = opts.folder if opts.folder is not None else tempfile.mkdtemp(prefix="tiepie_bench_")
+    results = []
+    for fmt in opts.formats:
+        for nchan in opts.channels:
+            for reclength in opts.record_lengths:
+                for fs in opts.sample_rates:
+                    for rot in opts.rotation:
+                        folder = os.path.join(root, "case")
+                        os.makedirs(folder, exist_ok=True)
+                        res = bench_write(fmt, nchan, reclength, fs, rot, opts.records, folder, opts.off_grid)
+                        shutil.rmtree(folder)
+                        if opts.realtime:
+                            os.makedirs(folder, exist_ok=True)
+                            rates = [1e5, 2e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2e7, 5e7, 1e8]
+                            res["realtime max fs"] = bench_realtime(fmt, nchan, reclength, rot, opts.duration, folder, rates)
+                            shutil.rmtree(folder)
+                        results.append(res)
+
+    print_table(results)
+    if opts.realtime:
+        print("Highest sampling frequency streamed without overflow:")
+        for res in results:
+            print("  ", res["format"], res["channels"], "channels, record length", res["record_length"], ":", res["realtime max fs"], "Hz")
+    if opts.output is not None:
+        save_table(results, opts.output)
+    if opts.folder is None:
+        shutil.rmtree(root)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,164 @@
+import concurrent.futures
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import zlib
+import h5py
+import numpy as np
+
+# Recompression of closed output files in a pool of worker processes, so that
+# compression scales over the cores and never runs in the acquisition or
+# writer threads.
+#   .hdf5        datasets rewritten with the shuffle filter + gzip (or lzf)
+#   .bin         per-channel delta + zlib, in blocks listed in the JSON header
+#   .csv / .tsv  gzip of the whole file (.csv.gz / .tsv.gz)
+
+POSTCOMPRESSION_LIST = ["none", "gzip", "lzf"]
+
+BLOCK_ROWS = 1<<20
+
+def compress_hdf5(fname, method, level):
+    tmpname = fname+".tmp"
+    if method=="lzf":
+        opts = {"compression":"lzf", "shuffle":True}
+    else:
+        opts = {"compression":"gzip", "compression_opts":level, "shuffle":True}
+
+    def copy_attrs(src, dst):
+        for key, val in src.attrs.items():
+            dst.attrs[key] = val
+
+    with h5py.File(fname, 'r') as src, h5py.File(tmpname, 'w') as dst:
+        copy_attrs(src, dst)
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Group):
+                copy_attrs(obj, dst.require_group(name))
+            elif obj.shape==() or obj.size==0:
+                src.copy(obj, dst, name=name)
+            else:
+                dset = dst.create_dataset(name, shape=obj.shape, dtype=obj.dtype, maxshape=obj.maxshape,
+                                          chunks=obj.chunks or True, **opts)
+                # copy long datasets by slabs, to bound memory use
+                step = BLOCK_ROWS
+                if obj.ndim==1 and obj.shape[0]>step:
+                    for i in range(0, obj.shape[0], step):
+                        dset[i:i+step] = obj[i:i+step]
+                else:
+                    dset[...] = obj[()]
+                copy_attrs(obj, dset)
+        src.visititems(visit)
+    os.replace(tmpname, fname)
+    return fname
+
+def delta_encode(x):
+    # lossless delta on the integer view of the samples (wrapping arithmetic)
+    u = x.view(np.dtype('u'+str(x.dtype.itemsize)))
+    d = np.empty_like(u)
+    d[0] = u[0]
+    np.subtract(u[1:], u[:-1], out=d[1:])
+    return d
+
+def delta_decode(d, dtype):
+    u = np.cumsum(d, dtype=d.dtype)
+    return u.view(dtype)
+
+def compress_bin(fname, level):
+    base = os.path.splitext(fname)[0]
+    with open(base+".json", 'r') as h:
+        info = json.load(h)
+    dtype = np.dtype(info["Dtype"])
+    nchan = info["N_channels"]
+    n = os.path.getsize(fname)//(nchan*dtype.itemsize)
+    data = np.memmap(fname, dtype=dtype, mode='r', shape=(n, nchan)) if n>0 else np.zeros((0, nchan), dtype=dtype)
+    blocks = []
+    with open(base+".binz", 'wb') as f:
+        for start in range(0, n, BLOCK_ROWS):
+            stop = min(n, start+BLOCK_ROWS)
+            sizes = []
+            for k in range(nchan):
+                buf = zlib.compress(delta_encode(np.ascontiguousarray(data[start:stop, k])).tobytes(), level)
+                f.write(buf)
+                sizes.append(len(buf))
+            blocks.append({"Start": start, "Stop": stop, "Sizes": sizes})
+    del data
+    info["N_samples"] = n
+    info["Compression"] = "delta-zlib"
+    info["Blocks"] = blocks
+    with open(base+".json", 'w') as h:
+        json.dump(info, h, indent=1)
+    os.remove(fname)
+    return base+".binz"
+
+def compress_text(fname, level):
+    with open(fname, 'rb') as src, gzip.open(fname+".gz", 'wb', compresslevel=level) as dst:
+        shutil.copyfileobj(src, dst, 1<<20)
+    os.remove(fname)
+    return fname+".gz"
+
+def compress_file(fname, method="gzip", level=4):
+    # compress one closed file in place of the original; returns statistics
+    t0 = time.perf_counter()
+    size_in = os.path.getsize(fname)
+    ext = os.path.splitext(fname)[1]
+    if ext==".hdf5":
+        out = compress_hdf5(fname, method, level)
+    elif ext==".bin":
+        out = compress_bin(fname, level)
+    elif ext in [".csv", ".tsv"]:
+        out = compress_text(fname, level)
+    else:
+        return {"file": fname, "error": "unknown format"}
+    dt = time.perf_counter()-t0
+    size_out = os.path.getsize(out)
+    return {"file": out, "method": method, "level": level,
+            "bytes_in": size_in, "bytes_out": size_out,
+            "ratio": size_in/max(1, size_out), "seconds": dt,
+            "MB_per_s": size_in/1e6/max(dt, 1e-9)}
+
+class Compressor():
+    # pool of worker processes compressing files submitted after they are closed
+    def __init__(self, method="gzip", level=4, workers=None):
+        self.method = method
+        self.level = level
+        if workers is None or workers<=0:
+            workers = max(1, (os.cpu_count() or 2)-1)
+        # workers are spawned, not forked: a forked worker would inherit the
+        # state of the HDF5 library, with the output files open in it
+        self.workers = workers
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        self.results = []
+
+    def start(self):
+        # the pool creates its processes on demand: start them all now
+        futs = [self.pool.submit(os.getpid) for k in range(self.workers)]
+        concurrent.futures.wait(futs)
+
+    def submit(self, fname):
+        fut = self.pool.submit(compress_file, fname, self.method, self.level)
+        fut.add_done_callback(self.done)
+
+    def done(self, fut):
+        try:
+            res = fut.result()
+        except Exception as e:
+            print("Compression error:", e)
+            return
+        with self.lock:
+            self.results.append(res)
+        if "error" in res:
+            print("Not compressed:", res["file"], "("+res["error"]+")")
+        else:
+            print("Compressed", res["file"], ": ratio", round(res["ratio"],2), ",", round(res["MB_per_s"],1), "MB/s")
+
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait)
+        if wait and len(self.results)>0:
+            size_in = sum([r.get("bytes_in", 0) for r in self.results])
+            size_out = sum([r.get("bytes_out", 0) for r in self.results])
+            print("Compressed", len(self.results), "file(s): overall ratio", round(size_in/max(1, size_out),2))
@@ -0,0 +1,111 @@
+import threading
+import time
+
+class DataReadyWaiter():
+    # Wait for the next record of a streaming oscilloscope without busy
+    # polling. When the device object can notify data ready / overflow
+    # through callbacks (a MultiScope, woken up by its device threads), the
+    # wait blocks on an event. Otherwise, which is always the case for a
+    # libtiepie oscilloscope, the thread sleeps for most of the expected
+    # record duration and then polls at a short interval, the sleep fraction
+    # being adapted to how early or late the data turned out to be.
+    def __init__(self, scp, period, min_poll=1e-4, max_poll=2e-3):
+        self.scp = scp
+        self.period = max(0.0, period)
+        self.poll = min(max_poll, max(min_poll, self.period/50))
+        self.frac = 0.8
+        self.last = time.perf_counter()
+
+        self.event = None
+        if hasattr(scp, "set_callback_data_ready"):
+            self.event = threading.Event()
+            scp.set_callback_data_ready(self.event.set)
+            if hasattr(scp, "set_callback_data_overflow"):
+                scp.set_callback_data_overflow(self.event.set)
+
+        self.n_wait = 0
+        self.n_polls = 0
+        self.n_immediate = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.cpu0 = time.process_time()
+        self.wall0 = time.perf_counter()
+
+    def ready(self):
+        return self.scp.is_data_ready or self.scp.is_data_overflow
+
+    def wait(self, stop=None):
+        # returns False if stop() became true before data was ready
+        t0 = time.perf_counter()
+        if self.event is not None:
+            ok = self.wait_event(stop)
+        else:
+            ok = self.wait_poll(stop)
+        t1 = time.perf_counter()
+        self.last = t1
+        self.n_wait = self.n_wait+1
+        self.wait_time = self.wait_time+(t1-t0)
+        self.max_wait = max(self.max_wait, t1-t0)
+        return ok
+
+    def wait_event(self, stop):
+        while not self.ready():
+            if stop is not None and stop():
+                return False
+            self.event.wait(max(self.period, 0.01))
+            self.event.clear()
+        return True
+
+    def wait_poll(self, stop):
+        # sleep until shortly before the record is expected
+        target = self.last+self.frac*self.period
+        dt = target-time.perf_counter()
+        if dt>0:
+            time.sleep(dt)
+        polls = 0
+        while not self.ready():
+            if stop is not None and stop():
+                return False
+            time.sleep(self.poll)
+            polls = polls+1
+        self.n_polls = self.n_polls+polls
+
+        # the latency of a polled record is bounded by the poll interval; a
+        # record found ready at once may have been waiting since the target
+        if polls==0:
+            self.n_immediate = self.n_immediate+1
+            lat = max(0.0, time.perf_counter()-self.last-self.frac*self.period)
+            self.frac = max(0.5, self.frac-0.05)
+        else:
+            lat = self.poll
+            if polls>5:
+                self.frac = min(0.95, self.frac+0.01)
+        self.latency = self.latency+lat
+        self.max_latency = max(self.max_latency, lat)
+        return True
+
+    def stats(self):
+        # the latency is only estimated when polling (None with an event)
+        wall = time.perf_counter()-self.wall0
+        n = max(1, self.n_wait)
+        polled = (self.event is None)
+        return {"records": self.n_wait,
+                "mode": "poll" if polled else "event",
+                "polls_per_record": self.n_polls/n,
+                "mean_wait": self.wait_time/n,
+                "max_wait": self.max_wait,
+                "mean_latency": self.latency/n if polled else None,
+                "max_latency": self.max_latency if polled else None,
+                "cpu_usage": (time.process_time()-self.cpu0)/max(wall, 1e-9)}
+
+    def print_stats(self):
+        st = self.stats()
+        print("Data ready wait (", st["mode"], "): mean", round(1e3*st["mean_wait"],3), "ms, max", round(1e3*st["max_wait"],3), "ms,",
+              round(st["polls_per_record"],2), "polls/record")
+        if st["mean_latency"] is None:
+            print("Estimated chunk latency: not measured")
+        else:
+            print("Estimated chunk latency: mean", round(1e3*st["mean_latency"],3), "ms, max", round(1e3*st["max_latency"],3), "ms")
+        print("Process CPU usage:", round(100*st["cpu_usage"],1), "%")
@@ -0,0 +1,36 @@
+import numpy as np
+
+def envelope(x, ncols):
+    # min and max of x over ncols columns of (nearly) equal width, so that
+    # no spike is lost whatever the decimation
+    x = np.asarray(x)
+    n = len(x)
+    if n==0:
+        return np.zeros(0), np.zeros(0)
+    if n<=ncols:
+        return x, x
+    edges = (np.arange(ncols)*n)//ncols
+    return np.minimum.reduceat(x, edges), np.maximum.reduceat(x, edges)
+
+def envelope_line(x, width, height, margin=20):
+    # flat list of canvas coordinates drawing the min/max envelope of x as
+    # one vertical stroke per pixel column, plus the overall min and max
+    lo, hi = envelope(x, int(width))
+    if len(lo)==0:
+        return [0, height/2, width, height/2], 0.0, 0.0
+    ymin = float(lo.min())
+    ymax = float(hi.max())
+    scale = (height-margin)/(1e-12 + ymax-ymin)
+    ncols = len(lo)
+    xs = np.repeat(np.arange(ncols)*(width/ncols), 2)
+    ys = np.empty(2*ncols)
+    # alternate the order of min and max so that consecutive strokes connect
+    ys[0::4] = hi[0::2]
+    ys[1::4] = lo[0::2]
+    ys[2::4] = lo[1::2]
+    ys[3::4] = hi[1::2]
+    ys = margin+(ymax-ys)*scale
+    line = np.empty(4*ncols)
+    line[0::2] = xs
+    line[1::2] = ys
+    return line.tolist(), ymin, ymax
@@ -0,0 +1,139 @@
+import queue
+import threading
+import numpy as np
+
+try:
+    import scipy.signal
+except ImportError:
+    scipy = None
+
+# Anti-alias filtering and decimation of the stream, record by record. The
+# filter state is carried over from one record to the next, so that the
+# output is the same as filtering the whole stream at once.
+
+FILTER_LIST = ["fir", "iir"]
+OUTPUT_LIST = ["replace", "both"]
+
+def lowpass_taps(factor, ntaps=None):
+    # windowed-sinc low-pass FIR, -6 dB at 80% of the decimated Nyquist frequency
+    if ntaps is None:
+        ntaps = 16*factor+1
+    fc = 0.8*0.5/factor
+    k = np.arange(ntaps)-(ntaps-1)/2.0
+    h = 2*fc*np.sinc(2*fc*k)*np.hamming(ntaps)
+    return (h/h.sum()).astype(np.float32)
+
+class Decimator():
+    # Filter and keep one sample out of factor, for the nchan channels of a
+    # record at once. Output samples are taken at the multiples of factor
+    # of the stream sample index; a gap in the stream (dropped records)
+    # resets the filter.
+    def __init__(self, nchan, factor, sample_rate, ftype="fir", ntaps=None):
+        self.nchan = nchan
+        self.factor = int(factor)
+        self.sample_rate = sample_rate
+        self.ftype = ftype
+        if ftype=="iir" and scipy is None:
+            print("scipy is not available, using a FIR filter for decimation")
+            self.ftype = "fir"
+        if self.ftype=="iir":
+            # as scipy.signal.decimate: Chebyshev type I, order 8
+            self.sos = scipy.signal.cheby1(8, 0.05, 0.8/self.factor, output='sos')
+            self.delay = 0.0
+        else:
+            self.taps = lowpass_taps(self.factor, ntaps)
+            # the FIR is linear phase, output times are corrected for its delay
+            self.delay = (len(self.taps)-1)/2.0
+        self.next_index = None
+        self.reset(0)
+
+    def reset(self, index):
+        if self.ftype=="iir":
+            self.zi = np.zeros((self.sos.shape[0], self.nchan, 2))
+        else:
+            self.tail = np.zeros((self.nchan, len(self.taps)-1), dtype=np.float32)
+        # position in the record of the next output sample
+        self.phase = (-index) % self.factor
+
+    def process(self, x, index):
+        # x[k] holds the samples of channel k, index is the stream index of
+        # the first one; returns the decimated samples and the stream index
+        # (in decimated samples) of the first of them
+        n = x.shape[1]
+        if index!=self.next_index:
+            self.reset(index)
+        self.next_index = index+n
+        p = self.phase
+        nout = max(0, -(-(n-p)//self.factor))
+        first = (index+p)//self.factor
+        M = self.factor
+        if self.ftype=="iir":
+            y, self.zi = scipy.signal.sosfilt(self.sos, x, axis=-1, zi=self.zi)
+            y = y[:, p::M].astype(np.float32)
+        else:
+            L = len(self.taps)
+            ext = np.concatenate([self.tail, x], axis=1)
+            y = np.zeros((self.nchan, nout), dtype=np.float32)
+            if nout>0:
+                for k in range(L):
+                    start = L-1+p-k
+                    y += self.taps[k]*ext[:, start:start+M*(nout-1)+1:M]
+            self.tail = ext[:, ext.shape[1]-(L-1):]
+        self.phase = p+M*nout-n
+        return y, first
+
+class DecimatedScope():
+    # stands for the oscilloscope when writing the decimated stream
+    def __init__(self, scp, factor):
+        self.channels = scp.channels
+        self.resolution = scp.resolution
+        self.sample_rate = scp.sample_rate/factor
+        self.record_length = -(-scp.record_length//factor)
+
+class DSPStage():
+    # Worker thread decimating the records held in the ring of buffers, and
+    # passing the result to output(data, count, stamp, index, clock).
+    def __init__(self, decimator, output):
+        self.decimator = decimator
+        self.output = output
+        self.queue = queue.Queue()
+        self.th = None
+        self.error = None
+
+    def start(self):
+        self.th = threading.Thread(target=self.run)
+        self.th.start()
+
+    def submit(self, data, release, count, stamp, index, clock):
+        self.queue.put((data, release, count, stamp, index, clock))
+
+    def run(self):
+        dec = self.decimator
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, release, count, stamp, index, clock = item
+            try:
+                y, first = dec.process(data, index)
+            except Exception as e:
+                if self.error is None:
+                    print("DSP error:", e)
+                self.error = e
+                release()
+                continue
+            release()
+            # time of the first output sample, corrected for the filter delay
+            t = stamp+(first*dec.factor-index-dec.delay)/dec.sample_rate
+            try:
+                self.output(y, count, t, first, clock)
+            except Exception as e:
+                if self.error is None:
+                    print("Write error (decimated stream):", e)
+                self.error = e
+
+    def close(self):
+        if self.th is not None:
+            self.queue.put(None)
+            self.th.join()
+            self.th = None
@@ -0,0 +1,1032 @@
+import argparse
+import datetime
+import math
+import os
+import signal
+import threading
+import time
+import h5py
+from pipeline import ChunkPipeline, POLICY_LIST
+from dataready import DataReadyWaiter
+from acquisition import RecordReader
+from monitor import StreamMonitor
+from compress import Compressor, POSTCOMPRESSION_LIST
+from dsp import Decimator, DecimatedScope, DSPStage, FILTER_LIST, OUTPUT_LIST
+from trigger import TriggerStage, ThresholdDetector, StaLtaDetector, TRIGGER_LIST
+from publish import Publisher
+from journal import Journal, recover_folder
+from multiscope import MultiScope
+from summary import Summarizer, SummaryStage
+from formats import create_index
+from formats import format_text_record, RawFileWriter, RecordIndex, count_scale, count_dtype, to_counts
+
+FILEEXT_LIST = [".hdf5", ".csv", ".tsv", ".bin"]
+TIMEUNIT_LIST = ["s", "min", "h", "d", "infty"]
+SIZEUNIT_LIST = ["MB", "samples"]
+NEWFILEUNIT_LIST = TIMEUNIT_LIST[:-1]+SIZEUNIT_LIST+["infty"]
+LAYOUT_LIST = ["chunks", "append"]
+COMPRESSION_LIST = ["none", "gzip", "lzf"]
+STORAGE_LIST = ["volts", "counts"]
+BACKEND_LIST = ["libtiepie", "simulator"]
+
+def get_backend(name="libtiepie"):
+    # device backend: the libtiepie module, or the simulator that mimics it
+    if name=="simulator":
+        import simulator
+        return simulator
+    import libtiepie
+    return libtiepie
+
+class StreamEngine():
+    # Device handling, streaming and file writing, independent of the GUI.
+    # Settings are plain attributes, with one entry per channel (16 at most,
+    # 4 instruments of 4 channels) in chan_enabled, chan_names and chan_ranges.
+    def __init__(self, backend=None):
+        if backend is None or isinstance(backend, str):
+            backend = get_backend(backend or "libtiepie")
+        self.lib = backend
+        self.scp = None
+        self.n_instr = 0
+        self.serial_numbers = []
+        self.streaming = False
+        # open all the independent devices found (4 at most), each read by
+        # its own thread, instead of the first one only
+        self.multidev = 0
+
+        self.foldername = os.path.expanduser('~')
+        self.filename = "datastream"
+        self.fileext = FILEEXT_LIST[0]
+        self.newfileperiod = 1.0
+        self.newfileunit = "infty"
+        # time periods start at multiples of the period in local time
+        self.newfilealign = 0
+        self.new_file_per = 0.0
+
+        self.freq = 0.0
+        self.res = 0
+        self.reclength = 0
+
+        self.chan_enabled = [0]*16
+        self.chan_names = ["Chan_"+str(c+1) for c in range(16)]
+        self.chan_ranges = [0.0]*16
+
+        self.queuedepth = 8
+        self.queuepolicy = POLICY_LIST[0]
+        self.h5layout = LAYOUT_LIST[0]
+        self.h5compression = COMPRESSION_LIST[0]
+        self.textdigits = 7
+        self.storage = STORAGE_LIST[0]
+        self.statslog = 0
+        self.statsinterval = 1.0
+        self.statsfile = None
+        # recompression of each file once closed, in worker processes
+        self.postcompression = POSTCOMPRESSION_LIST[0]
+        self.compresslevel = 4
+        self.compressworkers = 0
+        # decimation of the stream (1: none), written instead of the raw
+        # stream ("replace") or in files named <base name>_dec ("both")
+        self.decimation = 1
+        self.dspfilter = FILTER_LIST[0]
+        self.dspoutput = OUTPUT_LIST[0]
+        # event-triggered capture: only the samples from pretrigger (s) before
+        # to posttrigger (s) after each detection on triggerchans (channel
+        # numbers separated by commas, all if empty) are written
+        self.trigger = TRIGGER_LIST[0]
+        self.triggerchans = ""
+        self.triggerlevel = 0.5
+        self.triggersta = 0.001
+        self.triggerlta = 0.1
+        self.pretrigger = 0.01
+        self.posttrigger = 0.05
+        # journaled mode: files are flushed and their state committed every
+        # flushinterval (s), and can be recovered after a crash
+        self.journal = 0
+        self.flushinterval = 1.0
+        # after a data overflow, restart the device into a new file instead
+        # of stopping
+        self.restart = 0
+        # statistics per record and per bin of summarybin (s), with a PSD of
+        # summarypsd samples per segment (0: none), written in
+        # <file base>_summary.hdf5 next to each output file
+        self.summary = 0
+        self.summarybin = 1.0
+        self.summarypsd = 1024
+        # live publication of the records to local subscribers (publish.py)
+        self.publish = 0
+        self.publishhost = "127.0.0.1"
+        self.publishport = 5555
+        # extra description of the stream, stored in the binary file headers
+        self.stream_info = {}
+
+        self.counts = False
+        self.gains = []
+        self.offsets = []
+
+        self.stop = False
+        self.pipe = None
+        self.monitor = None
+        self.compressor = None
+        self.dsp = None
+        self.dec_engine = None
+        self.trig = None
+        self.publisher = None
+        self.summarizer = None
+        self.run_th = None
+        # called from the acquisition thread with each record, e.g. by the
+        # watch, as on_data(data, okchans, release) where data[k] holds the
+        # samples of channel okchans[k]; data is a slot of the ring of
+        # buffers and release() must be called once it is no longer used
+        self.on_data = None
+
+    def open_dev(self):
+        # returns the list of serial numbers of the opened instrument(s)
+        print("Update device list...")
+        self.lib.device_list.update()
+        print("Found ", len(self.lib.device_list), " devices")
+        devlist = self.lib.device_list
+        self.serial_numbers = []
+        self.n_instr = 0
+        if len(devlist)==0:
+            print("Oscilloscope(s) cannot be opened")
+            return []
+        ids = [device._get_product_id() for device in devlist]
+        if 2 in ids:
+            print("Found combined oscilloscope device")
+            device = devlist[ids.index(2)]
+            if device.can_open(self.lib.DEVICETYPE_OSCILLOSCOPE):
+                print("Opening", device.name, "#", device.serial_number)
+                self.scp = device.open_oscilloscope()
+                print("Contained serial numbers:")
+                for _sn in device.contained_serial_numbers:
+                    print(_sn)
+                    self.serial_numbers.append(_sn)
+            else:
+                print("Cannot open device")
+                return []
+        elif self.multidev and len(devlist)>1:
+            print("Independent devices")
+            scps = []
+            for device in list(devlist)[:4]:
+                if device.can_open(self.lib.DEVICETYPE_OSCILLOSCOPE):
+                    print("Opening", device.name, "#", device.serial_number)
+                    scps.append(device.open_oscilloscope())
+                    self.serial_numbers.append(device.serial_number)
+                else:
+                    print("Cannot open device #", device.serial_number)
+            if len(scps)==0:
+                return []
+            self.scp = MultiScope(scps, self.lib, self.serial_numbers, depth=self.queuedepth)
+        else:
+            print("Single device")
+            device = devlist[0]
+            if device.can_open(self.lib.DEVICETYPE_OSCILLOSCOPE):
+                print("Opening", device.name, "#", device.serial_number)
+                self.scp = device.open_oscilloscope()
+                self.serial_numbers.append(device.serial_number)
+            else:
+                print("Cannot open device")
+                return []
+
+        self.n_instr = len(self.serial_numbers)
+        self.streaming = bool(self.scp.measure_modes & self.lib.MM_STREAM)
+        if not self.streaming:
+            print("Device does not support streaming mode")
+
+        return self.serial_numbers
+
+    def close_dev(self):
+        print("Close devices...")
+        self.scp = None
+        self.n_instr = 0
+        self.serial_numbers = []
+        self.streaming = False
+
+    def arm_dev(self):
+        print("Arm device...")
+        # set scope parameters:
+        self.scp.sample_rate = self.freq
+        self.scp.resolution = self.res
+        self.scp.record_length = self.reclength
+        self.scp.measure_mode = self.lib.MM_STREAM
+        if isinstance(self.scp, MultiScope):
+            self.scp.depth = self.queuedepth
+
+        # read it back to check:
+        self.freq = self.scp.sample_rate
+        self.res = self.scp.resolution
+        self.reclength = self.scp.record_length
+
+        for c, chan in enumerate(self.scp.channels):
+            chan.enabled = self.chan_enabled[c]
+            if self.chan_ranges[c]>0:
+                chan.range = self.chan_ranges[c]
+            chan.coupling = self.lib.CK_DCV
+
+    def compute_period(self, value, unit):
+        if unit=='s':
+            return value
+        elif unit=='min':
+            return value*60
+        elif unit=='h':
+            return value*3600
+        elif unit=='d':
+            return value*3600*24
+
+    def start_streaming(self):
+        self.arm_dev()
+        self.stop = False
+        self.run_th = threading.Thread(target=self.run_streaming)
+        self.run_th.start()
+
+    def stop_streaming(self, wait=False):
+        self.stop = True
+        if self.run_th is not None and wait:
+            self.run_th.join()
+        self.run_th = None
+
+    def compute_file_samples(self, value, unit):
+        # samples per channel in each file, for rotation by size
+        if unit=='samples':
+            return max(1, int(value))
+        if self.fileext in [".csv", ".tsv"]:
+            # estimated width of a formatted sample
+            row = (self.textdigits+7)*len(self.okchans)
+        elif self.counts:
+            row = self.count_dtype.itemsize*len(self.okchans)
+        else:
+            row = 4*len(self.okchans)
+        return max(1, int(value*1e6/max(1, row)))
+
+    def next_boundary(self, t):
+        # end time of a file starting at time t; aligned periods end at the
+        # next multiple of the period in local time (e.g. on the hour)
+        if not self.newfilealign:
+            return t+self.new_file_per
+        off = time.localtime(t).tm_gmtoff
+        return (math.floor((t+off)/self.new_file_per)+1)*self.new_file_per-off
+
+    def file_name(self, fcount):
+        if self.rotate or self.restart:
+            return self.fname+str(fcount).rjust(6,'0')+self.fileext
+        return self.fname+self.fileext
+
+    def init_output(self, okchans, start=None):
+        # prepare file naming, rotation and scaling, and open the first file
+        self.fname = os.path.join(self.foldername, self.filename)
+        self.rotate = (self.newfileunit!="infty")
+        self.okchans = okchans
+        self.compute_scales(okchans)
+        self.layout = self.h5layout
+        if self.journal and self.fileext==".hdf5" and self.layout!="append":
+            # groups cannot be added to files written in SWMR mode
+            print("Journaled mode: using the append layout")
+            self.layout = "append"
+        self.journals = {}
+        self.t_flush = time.time()
+        self.new_file_at = set()
+        if self.journal:
+            recover_folder(self.foldername, self.filename)
+
+        # rotation either after a number of samples per channel, or at the
+        # time of a sample crossing t_boundary; files are split within records
+        self.fcount = 0
+        self.sample_index = 0
+        self.file_samples = 0
+        self.file_samples_max = 0
+        self.new_file_per = 0.0
+        self.t_boundary = None
+        if self.newfileunit in SIZEUNIT_LIST:
+            self.file_samples_max = self.compute_file_samples(self.newfileperiod, self.newfileunit)
+        elif self.rotate:
+            self.new_file_per = self.compute_period(self.newfileperiod, self.newfileunit)
+            if start is not None:
+                self.t_boundary = self.next_boundary(start)
+
+        # compression workers are all started before any output file is
+        # open, so that none is created while one is
+        if self.postcompression!="none":
+            self.compressor = Compressor(self.postcompression, self.compresslevel, self.compressworkers)
+            self.compressor.start()
+        else:
+            self.compressor = None
+
+        self.fullfilename = self.file_name(self.fcount)
+        print("Make new file:", self.fullfilename)
+        self.file = self.init_file(self.fullfilename)
+        self.file_started = False
+        self.index = None
+
+        # the next file is opened ahead of time, and the previous ones closed,
+        # in background threads
+        self.next_file = None
+        self.open_th = None
+        self.closing = []
+        if self.rotate or self.restart:
+            self.prepare_next_file()
+
+    def prepare_next_file(self):
+        self.next_name = self.file_name(self.fcount+1)
+        self.next_file = None
+        self.open_th = threading.Thread(target=self.open_next_file)
+        self.open_th.start()
+
+    def open_next_file(self):
+        try:
+            self.next_file = self.init_file(self.next_name)
+        except Exception as e:
+            print("Cannot open", self.next_name, "in advance:", e)
+            self.next_file = None
+
+    def finish_file(self, f, index, fname):
+        if index is not None:
+            index.close()
+        f.close()
+        if fname in self.journals:
+            self.journals.pop(fname).close()
+        if self.compressor is not None:
+            self.compressor.submit(fname)
+
+    def rotate_file(self, t):
+        # switch to the pre-opened file, whose first sample is at time t
+        if self.summarizer is not None:
+            self.summarizer.end_file(self.fullfilename, self.sample_index)
+        self.open_th.join()
+        if self.next_file is None:
+            self.next_file = self.init_file(self.next_name)
+        th = threading.Thread(target=self.finish_file, args=(self.file, self.index, self.fullfilename))
+        th.start()
+        self.closing.append(th)
+
+        self.file = self.next_file
+        self.fullfilename = self.next_name
+        self.fcount = self.fcount+1
+        print("Make new file:", self.fullfilename)
+        self.file_samples = 0
+        if self.t_boundary is not None:
+            self.t_boundary = self.t_boundary+self.new_file_per
+        self.start_file(self.file, self.sample_index, t)
+        self.prepare_next_file()
+
+    def samples_left(self, t):
+        # samples that still go into the current file, the next one being at time t
+        if self.file_samples_max>0:
+            return self.file_samples_max-self.file_samples
+        if self.t_boundary is None:
+            self.t_boundary = self.next_boundary(t)
+        return max(0, int(math.ceil((self.t_boundary-t)*self.scp.sample_rate)))
+
+    def close_output(self):
+        if not self.file_started:
+            self.start_file(self.file, self.sample_index, time.time())
+        if self.summarizer is not None:
+            self.summarizer.end_file(self.fullfilename)
+        self.finish_file(self.file, self.index, self.fullfilename)
+        self.index = None
+        if self.open_th is not None:
+            # remove the file opened in advance
+            self.open_th.join()
+            if self.next_file is not None:
+                self.next_file.close()
+                if self.next_name in self.journals:
+                    self.journals.pop(self.next_name).close()
+                os.remove(self.next_name)
+                if self.fileext==".bin":
+                    os.remove(self.next_file.header_name)
+            self.open_th = None
+            self.next_file = None
+        for th in self.closing:
+            th.join()
+        self.closing = []
+        if self.compressor is not None:
+            self.compressor.close(wait=True)
+            self.compressor = None
+
+    def init_decimation(self, okchans):
+        # the decimated stream is written by a second engine, with the same
+        # file settings, fed by a DSP worker thread
+        dec = StreamEngine(self.lib)
+        for key in ["foldername", "filename", "fileext", "newfileperiod", "newfileunit", "newfilealign",
+                    "chan_names", "h5layout", "h5compression", "textdigits", "journal", "flushinterval",
+                    "postcompression", "compresslevel", "compressworkers"]:
+            setattr(dec, key, getattr(self, key))
+        if self.dspoutput=="both":
+            dec.filename = self.filename+"_dec"
+        else:
+            dec.monitor = self.monitor
+        # filtered samples are no longer integer codes
+        dec.storage = "volts"
+        dec.scp = DecimatedScope(self.scp, self.decimation)
+        decimator = Decimator(len(okchans), self.decimation, self.scp.sample_rate, self.dspfilter)
+        dec.stream_info = {"Decimation": self.decimation, "Decimation_filter": decimator.ftype,
+                           "Source_sampling_freq": self.scp.sample_rate}
+        print("Decimated stream:", dec.scp.sample_rate, "Hz")
+        dec.init_output(okchans)
+        self.dec_engine = dec
+        self.dsp = DSPStage(decimator, dec.write_chunk)
+        self.dsp.start()
+
+    def init_trigger(self, okchans):
+        fs = self.scp.sample_rate
+        numbers = [c.strip() for c in self.triggerchans.split(",") if c.strip()!=""]
+        chans = [k for k, c in enumerate(okchans) if str(c+1) in numbers]
+        if len(chans)==0:
+            chans = list(range(len(okchans)))
+        if self.trigger=="threshold":
+            detector = ThresholdDetector(len(chans), self.triggerlevel)
+        else:
+            detector = StaLtaDetector(len(chans), self.triggerlevel, self.triggersta*fs, self.triggerlta*fs)
+        catalogue = os.path.join(self.foldername, self.filename)+"_events.csv"
+        print("Trigger on channels", [okchans[k]+1 for k in chans], ", event catalogue:", catalogue)
+        names = [self.chan_names[c] for c in okchans]
+        return TriggerStage(detector, chans, len(okchans), fs, self.pretrigger*fs, self.posttrigger*fs,
+                            self.write_chunk, catalogue, names)
+
+    def init_publisher(self, okchans):
+        try:
+            pub = Publisher(self.publishhost, self.publishport)
+        except OSError as e:
+            print("Cannot publish on port", self.publishport, ":", e)
+            return None
+        self.compute_scales(okchans)
+        if self.counts:
+            pub.configure(okchans, self.scp.sample_rate, self.gains, self.offsets, self.count_dtype)
+        else:
+            pub.configure(okchans, self.scp.sample_rate)
+        print("Publishing records on", self.publishhost, "port", pub.port)
+        pub.start()
+        return pub
+
+    def init_summary(self, okchans):
+        fs = self.scp.sample_rate
+        info = {"Sampling_freq": fs, "Channels": [self.chan_names[c] for c in okchans]}
+        stage = SummaryStage(Summarizer(len(okchans), fs, self.summarybin, self.summarypsd), info)
+        print("Summary every", self.summarybin, "s")
+        stage.start()
+        return stage
+
+    def skip_chunk(self, data, count, stamp, index=None, clock=None):
+        pass
+
+    def run_streaming(self):
+
+        okchans = self.chan_indices()
+        count = 0
+
+        print("Acquiring on channels:", okchans)
+        if isinstance(self.scp, MultiScope):
+            self.stream_info["Serial_numbers"] = list(self.serial_numbers)
+        write_raw = (self.decimation<=1 or self.dspoutput=="both")
+        if write_raw:
+            self.init_output(okchans)
+
+        # records are persisted by the writer thread of the pipeline, or
+        # first go through the trigger in that thread
+        write_func = self.write_chunk if write_raw else self.skip_chunk
+        self.trig = None
+        if write_raw and self.trigger!="none":
+            self.trig = self.init_trigger(okchans)
+            write_func = self.trig.process
+        self.pipe = ChunkPipeline(write_func, len(okchans), self.scp.record_length,
+                                  depth=self.queuedepth, policy=self.queuepolicy)
+        self.pipe.start()
+
+        logname = None
+        if self.statslog:
+            logname = self.statsfile if self.statsfile else os.path.join(self.foldername, self.filename)+"_stats.jsonl"
+            print("Stats log:", logname)
+        self.monitor = StreamMonitor(self.pipe, len(okchans), self.scp.record_length, self.scp.sample_rate,
+                                     interval=self.statsinterval, logname=logname)
+
+        self.dsp = None
+        if self.decimation>1:
+            self.init_decimation(okchans)
+
+        self.publisher = None
+        if self.publish:
+            self.publisher = self.init_publisher(okchans)
+
+        # summaries go with the raw output files
+        self.summarizer = None
+        if self.summary and write_raw:
+            self.summarizer = self.init_summary(okchans)
+
+        waiter = DataReadyWaiter(self.scp, self.scp.record_length/self.scp.sample_rate)
+        reader = RecordReader(self.scp, self.lib, okchans)
+        print("Reading records in", reader.mode, "mode")
+
+        # records are time stamped from their first sample index and the
+        # sample rate, relative to the start of the stream
+        fs = self.scp.sample_rate
+        index = 0
+        t0 = time.time()
+        self.scp.start()
+        self.t_start = 0.5*(t0+time.time())
+
+        while not self.stop:
+            t0 = time.perf_counter()
+            if not waiter.wait(lambda: self.stop):
+                break
+
+            if self.scp.is_data_overflow:
+                if not self.restart:
+                    print("Data overflow!")
+                    break
+                index = self.restart_dev(index)
+                continue
+
+            # read straight into a free slot of the ring (or the scratch
+            # buffer if the record is to be dropped)
+            t1 = time.perf_counter()
+            slot = self.pipe.acquire()
+            t2 = time.perf_counter()
+            n = reader.read_into(self.pipe.buffer(slot))
+            clock = time.time()
+            t3 = time.perf_counter()
+            stamp = self.t_start+index/fs
+            if slot is not None:
+                self.pipe.set_length(slot, n)
+                if self.on_data is not None:
+                    self.pipe.hold(slot)
+                    self.on_data(self.pipe.record(slot), okchans, lambda slot=slot: self.pipe.release(slot))
+                if self.dsp is not None:
+                    self.pipe.hold(slot)
+                    self.dsp.submit(self.pipe.record(slot), lambda slot=slot: self.pipe.release(slot), count, stamp, index, clock)
+                if self.publisher is not None:
+                    self.pipe.hold(slot)
+                    self.publisher.submit(self.pipe.record(slot), lambda slot=slot: self.pipe.release(slot), count, stamp, index)
+                if self.summarizer is not None:
+                    self.pipe.hold(slot)
+                    self.summarizer.submit(self.pipe.record(slot), lambda slot=slot: self.pipe.release(slot), stamp, index)
+                self.pipe.submit(slot, count, stamp, index, clock)
+            self.monitor.add_acq(count, t1-t0, t3-t2, t2-t1, self.pipe.queued())
+            self.monitor.add_clock(self.t_start+(index+n)/fs, clock)
+
+            count = count+1
+            index = index+n
+
+        self.scp.stop()
+        reader.close()
+        if reader.mode=="copy":
+            print("Time copying (s):", round(reader.copy_time,3))
+        self.pipe.close()
+        if self.trig is not None:
+            self.trig.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.dsp is not None:
+            self.dsp.close()
+            self.dec_engine.close_output()
+        if write_raw:
+            self.close_output()
+        if self.summarizer is not None:
+            self.summarizer.close()
+            self.summarizer = None
+        self.monitor.close()
+        self.pipe.print_counters()
+        waiter.print_stats()
+        if isinstance(self.scp, MultiScope):
+            self.scp.print_stats()
+
+    def restart_dev(self, index):
+        # the samples lost while the device was stopped are estimated from
+        # the time elapsed; returns the stream index after the gap
+        fs = self.scp.sample_rate
+        self.scp.stop()
+        t0 = time.time()
+        self.scp.start()
+        t = 0.5*(t0+time.time())
+        new_index = max(index, int(round((t-self.t_start)*fs)))
+        gap = new_index-index
+        print("Data overflow! Restarting after a gap of", gap, "samples (", round(gap/fs, 3), "s )")
+        logname = os.path.join(self.foldername, self.filename)+"_gaps.csv"
+        new = not os.path.exists(logname)
+        with open(logname, 'a') as f:
+            if new:
+                f.write("Date;Sample;Gap (samples);Gap (s)"+"\n")
+            f.write(str(datetime.datetime.fromtimestamp(t))+";"+str(index)+";"+str(gap)+";"+str(gap/fs)+"\n")
+        self.new_file_at.add(new_index)
+        return new_index
+
+    def flush_file(self):
+        # commit what has been written to the current file (journaled mode)
+        if self.index is not None:
+            self.index.flush()
+        self.file.flush()
+        state = {"samples": self.file_samples, "rows": self.index.n_flushed if self.index is not None else 0, "bytes": 0}
+        if self.fileext in [".csv", ".tsv"]:
+            state["bytes"] = self.file.tell()
+        if self.fullfilename in self.journals:
+            self.journals[self.fullfilename].commit(state)
+        self.t_flush = time.time()
+
+    def write_chunk(self, data, count, stamp, index=None, clock=None):
+        # called from the writer thread of the pipeline; stamp is the time
+        # of the first sample of the record, index its position in the
+        # stream (records may have been dropped) and clock the system time
+        # when it was read
+        t0 = time.perf_counter()
+        if index is not None:
+            self.sample_index = index
+        if clock is None:
+            clock = stamp
+        if self.counts:
+            data = to_counts(data, self.gains, self.offsets, self.count_dtype)
+        if not self.file_started:
+            self.start_file(self.file, self.sample_index, stamp)
+        elif index in self.new_file_at and self.file_samples>0:
+            # first record after a restart of the device
+            self.new_file_at.discard(index)
+            self.t_boundary = None
+            self.rotate_file(stamp)
+        n = len(data[0])
+        fs = self.scp.sample_rate
+        t_rotate = 0.0
+        pos = 0
+        while True:
+            k = n-pos
+            split = False
+            if self.rotate:
+                left = self.samples_left(stamp+pos/fs)
+                if left<k:
+                    k = left
+                    split = True
+            if k>0:
+                self.write_data(data[:, pos:pos+k], self.okchans, count, self.file)
+                if self.index is not None:
+                    self.index.add(count, self.sample_index, self.file_samples, k, stamp+pos/fs, clock)
+                self.file_samples = self.file_samples+k
+                self.sample_index = self.sample_index+k
+                pos = pos+k
+            if not split:
+                break
+            t1 = time.perf_counter()
+            self.rotate_file(stamp+pos/fs)
+            t_rotate = t_rotate+time.perf_counter()-t1
+
+        if self.journal and time.time()-self.t_flush>=self.flushinterval:
+            self.flush_file()
+        if self.monitor is not None:
+            self.monitor.add_write(count, time.perf_counter()-t0-t_rotate, t_rotate)
+
+    def compute_scales(self, ch):
+        # integer codes are only stored by the binary file formats
+        self.counts = (self.storage=="counts" and self.fileext in [".hdf5", ".bin"])
+        self.count_dtype = count_dtype(self.scp.resolution)
+        self.gains = []
+        self.offsets = []
+        for c in ch:
+            gain, offset = count_scale(self.scp.channels[c].range, self.scp.resolution)
+            self.gains.append(gain)
+            self.offsets.append(offset)
+
+    def chan_indices(self):
+        ind = []
+        for c, chan in enumerate(self.scp.channels):
+            if chan.enabled:
+                ind.append(c)
+        return ind
+
+    def get_chan_names(self):
+        return list(self.chan_names)
+
+    def init_file(self, fname):
+        # the file is only created here (possibly in advance); the date and
+        # first sample are set by start_file
+        if self.journal:
+            self.journals[fname] = Journal(fname)
+        if self.fileext in [".csv", ".tsv"]:
+            return open(fname, 'w', buffering=1<<20)
+
+        elif self.fileext==".hdf5":
+            if self.journal:
+                f = h5py.File(fname, 'w', libver='latest')
+            else:
+                f = h5py.File(fname,'w')
+            info = f.create_group("Info")
+            info.attrs["Sampling_freq"] = self.scp.sample_rate
+            info.attrs["Resolution"] = self.scp.resolution
+            info.attrs["Record_length"] = self.scp.record_length
+            info.attrs["Layout"] = self.layout
+            info.attrs["Storage"] = "counts" if self.counts else "volts"
+            for key, val in self.stream_info.items():
+                info.attrs[key] = val
+            k = 0
+            for c, chan in enumerate(self.scp.channels):
+                if chan.enabled:
+                    info.attrs["chan"+str(c+1).rjust(2,'0')] = self.chan_names[c]
+                    if self.counts:
+                        info.attrs["chan"+str(c+1).rjust(2,'0')+"_gain"] = self.gains[k]
+                        info.attrs["chan"+str(c+1).rjust(2,'0')+"_offset"] = self.offsets[k]
+                    k = k+1
+
+            index = f.create_group("Index")
+            if self.layout=="append":
+                self.init_append_datasets(f)
+            if self.journal:
+                # all datasets must exist before switching to SWMR mode
+                create_index(index)
+
+            return f
+
+        elif self.fileext==".bin":
+            names = self.get_chan_names()
+            info = {"Sampling_freq": self.scp.sample_rate,
+                    "Resolution": self.scp.resolution,
+                    "Record_length": self.scp.record_length,
+                    "Channels": []}
+            info.update(self.stream_info)
+            for c, chan in enumerate(self.scp.channels):
+                if chan.enabled:
+                    info["Channels"].append({"Index": c+1, "Name": names[c], "Range": chan.range})
+                    if self.counts:
+                        k = len(info["Channels"])-1
+                        info["Channels"][k]["Gain"] = self.gains[k]
+                        info["Channels"][k]["Offset"] = self.offsets[k]
+
+            dtype = self.count_dtype if self.counts else 'float32'
+            return RawFileWriter(fname, info, len(info["Channels"]), dtype=dtype, prealloc=256*self.scp.record_length)
+
+    def start_file(self, f, first, t):
+        # index (since the start of the stream) and time of the first sample
+        date = str(datetime.datetime.fromtimestamp(t))
+        if self.fileext in [".csv", ".tsv"]:
+            f.write("Date:"+date+os.linesep)
+            f.write("First sample:"+str(first)+os.linesep)
+            f.write("Sampling freq:"+str(self.scp.sample_rate)+os.linesep)
+            f.write("Resolution:"+str(self.scp.resolution)+os.linesep)
+            f.write("Record length:"+str(self.scp.record_length)+os.linesep)
+            f.write(os.linesep)
+            names = []
+            for c, chan in enumerate(self.scp.channels):
+                if chan.enabled:
+                    names.append(self.chan_names[c])
+            if self.fileext==".csv":
+                f.write(''.join([';'+name for name in names]))
+            else:
+                f.write('\t'.join(names))
+
+            f.write(os.linesep)
+
+        elif self.fileext==".hdf5":
+            f["Info"].attrs["Date"] = date
+            f["Info"].attrs["First_sample"] = first
+            f["Info"].attrs["Start_time"] = t
+            self.index = RecordIndex(f["Index"])
+            if self.journal:
+                f.swmr_mode = True
+
+        elif self.fileext==".bin":
+            f.info["Date"] = date
+            f.info["First_sample"] = first
+            f.info["Start_time"] = t
+            self.index = RecordIndex(os.path.splitext(f.fname)[0]+".idx")
+        self.file_started = True
+
+    def init_append_datasets(self, f):
+        # one resizable dataset per channel, extended in place for each record;
+        # the position of each record in the file is given by the index
+        opts = {}
+        if self.h5compression=="gzip":
+            opts = {"compression":"gzip", "compression_opts":4, "shuffle":True}
+        elif self.h5compression=="lzf":
+            opts = {"compression":"lzf", "shuffle":True}
+        chunk = max(1, min(self.scp.record_length, 1<<20))
+        dtype = self.count_dtype if self.counts else 'float32'
+        k = 0
+        for c, chan in enumerate(self.scp.channels):
+            if chan.enabled:
+                dset = f.create_dataset("chan"+str(c+1).rjust(2,'0'), shape=(0,), maxshape=(None,),
+                                        chunks=(chunk,), dtype=dtype, **opts)
+                if self.counts:
+                    dset.attrs["Gain"] = self.gains[k]
+                    dset.attrs["Offset"] = self.offsets[k]
+                k = k+1
+
+    def write_data(self, data, ch, count, f):
+        # data[k] holds the samples of channel ch[k]
+        if self.fileext==".csv":
+            f.write(format_text_record(data, ';', self.textdigits, gains=self.gains, offsets=self.offsets,
+                                       resolution=self.scp.resolution))
+
+        elif self.fileext==".tsv":
+            f.write(format_text_record(data, '\t', self.textdigits, lead=False, gains=self.gains,
+                                       offsets=self.offsets, resolution=self.scp.resolution))
+
+        elif self.fileext==".bin":
+            f.write(data)
+
+        elif self.fileext==".hdf5" and self.layout=="append":
+            n = len(data[0])
+            start = f["chan"+str(ch[0]+1).rjust(2,'0')].shape[0]
+            for k, c in enumerate(ch):
+                dset = f["chan"+str(c+1).rjust(2,'0')]
+                dset.resize((start+n,))
+                dset[start:] = data[k]
+
+        elif self.fileext==".hdf5":
+            grp = f.create_group("chunk_"+str(count).rjust(8,'0'))
+            for k, c in enumerate(ch):
+                grp.create_dataset("chan"+str(c+1).rjust(2,'0'), data=data[k])
+
+    def save_config_file(self, filename):
+        print("Save config file as", filename, "...")
+        f = open(filename, "w", newline='\n')
+        f.write("Date:"+str(datetime.datetime.now())+'\n')
+        f.write("File format:"+self.fileext+'\n')
+        f.write("New file period:"+str(self.newfileperiod)+'\n')
+        f.write("New file unit:"+str(self.newfileunit)+'\n')
+        f.write("Sampling freq:"+str(self.freq)+'\n')
+        f.write("Resolution:"+str(self.res)+'\n')
+        f.write("Record length:"+str(self.reclength)+'\n')
+        for _i in [0,1,2,3]:
+            for _c in [0,1,2,3]:
+                c = 4*_i+_c
+                name = "Instr"+str(_i+1)+"_Chan"+str(_c+1)+":"
+                f.write(name+str(self.chan_enabled[c])+'\n')
+                f.write(name+self.chan_names[c]+'\n')
+                f.write(name+str(self.chan_ranges[c])+'\n')
+        f.write("Folder:"+self.foldername+'\n')
+        f.write("File base name:"+self.filename+'\n')
+        f.write("Queue depth:"+str(self.queuedepth)+'\n')
+        f.write("Queue policy:"+self.queuepolicy+'\n')
+        f.write("HDF5 layout:"+self.h5layout+'\n')
+        f.write("HDF5 compression:"+self.h5compression+'\n')
+        f.write("Text digits:"+str(self.textdigits)+'\n')
+        f.write("Sample storage:"+self.storage+'\n')
+        f.write("Stats log:"+str(self.statslog)+'\n')
+        f.write("Post compression:"+self.postcompression+'\n')
+        f.write("Compression level:"+str(self.compresslevel)+'\n')
+        f.write("Compression workers:"+str(self.compressworkers)+'\n')
+        f.write("Align new files:"+str(self.newfilealign)+'\n')
+        f.write("Decimation:"+str(self.decimation)+'\n')
+        f.write("Decimation filter:"+self.dspfilter+'\n')
+        f.write("Decimation output:"+self.dspoutput+'\n')
+        f.write("Trigger:"+self.trigger+'\n')
+        f.write("Trigger channels:"+self.triggerchans+'\n')
+        f.write("Trigger level:"+str(self.triggerlevel)+'\n')
+        f.write("STA:"+str(self.triggersta)+'\n')
+        f.write("LTA:"+str(self.triggerlta)+'\n')
+        f.write("Pre-trigger:"+str(self.pretrigger)+'\n')
+        f.write("Post-trigger:"+str(self.posttrigger)+'\n')
+        f.write("Journal:"+str(self.journal)+'\n')
+        f.write("Flush interval:"+str(self.flushinterval)+'\n')
+        f.write("Restart after overflow:"+str(self.restart)+'\n')
+        f.write("Multiple devices:"+str(self.multidev)+'\n')
+        f.write("Summary:"+str(self.summary)+'\n')
+        f.write("Summary bin:"+str(self.summarybin)+'\n')
+        f.write("Summary PSD length:"+str(self.summarypsd)+'\n')
+        f.write("Publish:"+str(self.publish)+'\n')
+        f.write("Publish host:"+self.publishhost+'\n')
+        f.write("Publish port:"+str(self.publishport)+'\n')
+
+        f.close()
+
+    def open_config_file(self, filename):
+        print("Open config file ", filename, "...")
+        f = open(filename, "r")
+        lines = f.readlines()
+        f.close()
+        self.fileext = lines[1].split(':')[1].strip("\n")
+        self.newfileperiod = float(lines[2].split(':')[1])
+        self.newfileunit = lines[3].split(':')[1].strip("\n")
+        self.freq = float(lines[4].split(':')[1])
+        self.res = int(lines[5].split(':')[1])
+        self.reclength = int(lines[6].split(':')[1])
+        n=7
+        for _i in [0,1,2,3]:
+            for _c in [0,1,2,3]:
+                c = 4*_i+_c
+                self.chan_enabled[c] = int(lines[n].split(':')[1])
+                self.chan_names[c] = lines[n+1].split(':')[1].strip("\n\r")
+                self.chan_ranges[c] = float(lines[n+2].split(':')[1])
+                n = n+3
+
+        # optional settings, absent from older config files
+        opts = {}
+        for line in lines[n:]:
+            if ':' in line:
+                key, val = line.split(':', 1)
+                opts[key] = val.strip("\n\r")
+        if "Folder" in opts:
+            self.foldername = opts["Folder"]
+        if "File base name" in opts:
+            self.filename = opts["File base name"]
+        if "Queue depth" in opts:
+            self.queuedepth = int(opts["Queue depth"])
+        if "Queue policy" in opts:
+            self.queuepolicy = opts["Queue policy"]
+        if "HDF5 layout" in opts:
+            self.h5layout = opts["HDF5 layout"]
+        if "HDF5 compression" in opts:
+            self.h5compression = opts["HDF5 compression"]
+        if "Text digits" in opts:
+            self.textdigits = int(opts["Text digits"])
+        if "Sample storage" in opts:
+            self.storage = opts["Sample storage"]
+        if "Stats log" in opts:
+            self.statslog = int(opts["Stats log"])
+        if "Post compression" in opts:
+            self.postcompression = opts["Post compression"]
+        if "Compression level" in opts:
+            self.compresslevel = int(opts["Compression level"])
+        if "Compression workers" in opts:
+            self.compressworkers = int(opts["Compression workers"])
+        if "Align new files" in opts:
+            self.newfilealign = int(opts["Align new files"])
+        if "Decimation" in opts:
+            self.decimation = int(opts["Decimation"])
+        if "Decimation filter" in opts:
+            self.dspfilter = opts["Decimation filter"]
+        if "Decimation output" in opts:
+            self.dspoutput = opts["Decimation output"]
+        if "Trigger" in opts:
+            self.trigger = opts["Trigger"]
+        if "Trigger channels" in opts:
+            self.triggerchans = opts["Trigger channels"]
+        if "Trigger level" in opts:
+            self.triggerlevel = float(opts["Trigger level"])
+        if "STA" in opts:
+            self.triggersta = float(opts["STA"])
+        if "LTA" in opts:
+            self.triggerlta = float(opts["LTA"])
+        if "Pre-trigger" in opts:
+            self.pretrigger = float(opts["Pre-trigger"])
+        if "Post-trigger" in opts:
+            self.posttrigger = float(opts["Post-trigger"])
+        if "Journal" in opts:
+            self.journal = int(opts["Journal"])
+        if "Flush interval" in opts:
+            self.flushinterval = float(opts["Flush interval"])
+        if "Restart after overflow" in opts:
+            self.restart = int(opts["Restart after overflow"])
+        if "Multiple devices" in opts:
+            self.multidev = int(opts["Multiple devices"])
+        if "Summary" in opts:
+            self.summary = int(opts["Summary"])
+        if "Summary bin" in opts:
+            self.summarybin = float(opts["Summary bin"])
+        if "Summary PSD length" in opts:
+            self.summarypsd = int(opts["Summary PSD length"])
+        if "Publish" in opts:
+            self.publish = int(opts["Publish"])
+        if "Publish host" in opts:
+            self.publishhost = opts["Publish host"]
+        if "Publish port" in opts:
+            self.publishport = int(opts["Publish port"])
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Stream TiePie oscilloscope data to disk without the GUI.")
+    parser.add_argument("config", help="config file, as saved by the GUI")
+    parser.add_argument("--folder", help="output folder (overrides the config file)")
+    parser.add_argument("--name", help="file base name (overrides the config file)")
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds (default: run until interrupted)")
+    parser.add_argument("--stats", help="append performance statistics (JSON lines) to this file")
+    parser.add_argument("--publish", type=int, metavar="PORT",
+                        help="publish the records live on this TCP port (read them with publish.py)")
+    parser.add_argument("--simulate", type=int, default=0, metavar="N_INSTR",
+                        help="use a simulated combined instrument of N_INSTR x 4 channels instead of libtiepie")
+    parser.add_argument("--separate", action="store_true",
+                        help="simulate N_INSTR independent devices instead of a combined instrument, and open them all")
+    opts = parser.parse_args(args)
+
+    if opts.simulate>0:
+        backend = get_backend("simulator")
+        backend.configure(n_instr=opts.simulate, combined=not opts.separate)
+    else:
+        backend = get_backend("libtiepie")
+    engine = StreamEngine(backend)
+    engine.open_config_file(opts.config)
+    if opts.folder is not None:
+        engine.foldername = opts.folder
+    if opts.name is not None:
+        engine.filename = opts.name
+    if opts.stats is not None:
+        engine.statslog = 1
+        engine.statsfile = opts.stats
+    if opts.separate:
+        engine.multidev = 1
+    if opts.publish is not None:
+        engine.publish = 1
+        engine.publishport = opts.publish
+
+    if len(engine.open_dev())==0 or not engine.streaming:
+        return 1
+
+    # Ctrl-C (or SIGTERM) stops the stream and closes the file cleanly
+    def interrupt(signum, frame):
+        engine.stop = True
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    engine.start_streaming()
+    t0 = time.time()
+    th = engine.run_th
+    while th.is_alive():
+        th.join(0.2)
+        if opts.duration>0 and time.time()-t0>=opts.duration:
+            engine.stop = True
+    engine.close_dev()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
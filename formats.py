@@ -0,0 +1,356 @@
+import os
+import json
+import numpy as np
+
+# Text output. A sample formatted with "%.<digits>g" (up to 7 digits, after
+# a separator of up to 2 characters) takes at most 16 bytes: it is laid out
+# in 2 little-endian 64-bit words, padded with NUL bytes that are removed
+# once the whole record is laid out.
+DIGITS4 = np.array([list(str(k).rjust(4, '0').encode())+[0]*4 for k in range(10000)], dtype=np.uint8).view('<u8').ravel()
+ZEROS4 = np.array([4]+[len(str(k))-len(str(k).rstrip('0')) for k in range(1, 10000)], dtype=np.int64)
+POW10 = 10.0**np.arange(-300, 301)
+BYTE_MASK = np.array([(1<<(8*k))-1 for k in range(9)], dtype='<u8')
+E_MIN = -330
+E_MAX = 330
+TEXT_TEMPLATES = {}
+
+def text_row(s):
+    # words of a sample formatted by python
+    row = np.zeros(16, dtype=np.uint8)
+    row[:len(s)] = np.frombuffer(s.encode(), dtype=np.uint8)
+    return row.view('<u8')
+
+def text_templates(digits, prefix):
+    # for each exponent e, number ns of significant digits and sign, the
+    # words of a sample but for its digits, how many digits are written,
+    # where the point goes among them and where they go (in bits)
+    key = (digits, prefix)
+    if not key in TEXT_TEMPLATES:
+        ncls = (E_MAX-E_MIN+1)*(digits+1)*2
+        words = np.zeros((ncls, 16), dtype=np.uint8)
+        kept = np.zeros(ncls, dtype=np.int64)
+        point = np.zeros(ncls, dtype=np.int64)
+        pchar = np.zeros(ncls, dtype='<u8')
+        start = np.zeros(ncls, dtype=np.int64)
+        for e in range(E_MIN, E_MAX+1):
+            for ns in range(1, digits+1):
+                for neg in range(2):
+                    c = ((e-E_MIN)*(digits+1)+ns)*2+neg
+                    head = prefix+"-"*neg
+                    tail = ""
+                    if -4<=e<digits:
+                        kept[c] = max(ns, e+1)
+                        point[c] = e+1
+                        if e<0:
+                            head = head+"0."+"0"*(-e-1)
+                            point[c] = digits
+                    else:
+                        kept[c] = ns
+                        point[c] = 1
+                        tail = "e%+03d" % e
+                    if kept[c]>point[c]:
+                        pchar[c] = ord('.')
+                    else:
+                        point[c] = kept[c]
+                    start[c] = len(head)
+                    pos = len(head)+kept[c]+int(pchar[c]>0)
+                    words[c, :len(head)] = np.frombuffer(head.encode(), dtype=np.uint8)
+                    words[c, pos:pos+len(tail)] = np.frombuffer(tail.encode(), dtype=np.uint8)
+        TEXT_TEMPLATES[key] = (words.view('<u8'), np.take(BYTE_MASK, kept), (8*point).astype('<u8'), pchar,
+                               (4*start).astype('<u8'), (32-4*start).astype('<u8'))
+    return TEXT_TEMPLATES[key]
+
+def format_samples(x, digits, prefix):
+    # words of prefix+"%.<digits>g" % v for every sample v of x, as printf
+    # would write them
+    fmt = prefix+"%."+str(digits)+"g"
+    words, masks, shifts, pchars, lo_shifts, hi_shifts = text_templates(digits, prefix)
+    x = np.asarray(x, dtype=np.float64)
+    a = np.abs(x)
+    ok = np.isfinite(x) & (a>0)
+    with np.errstate(divide='ignore'):
+        e = np.floor(np.log10(np.where(ok, a, 1.0))).astype(np.int64)
+    # (powers of ten are kept well within the range of float64)
+    huge = ok & (np.abs(e)>280)
+    ok = ok & ~huge
+    e[~ok] = 0
+    a = np.where(ok, a, 0.0)
+
+    # mantissa of digits digits, with e corrected where log10 is one off
+    k = digits-1-e
+    s = a*np.take(POW10, 300+k)
+    fix = np.flatnonzero(ok & ((s<10.0**(digits-1)) | (s>=10.0**digits)))
+    if len(fix)>0:
+        e[fix] = e[fix]+np.where(s[fix]>=10.0**digits, 1, -1)
+        k[fix] = digits-1-e[fix]
+        s[fix] = a[fix]*np.take(POW10, 300+k[fix])
+    m = np.rint(s)
+    carry = (m>=10.0**digits)
+    m[carry] = 10.0**(digits-1)
+    e[carry] = e[carry]+1
+    # s is exact for float32 samples and 0<=k<=12 (24+28 bits), rounded half
+    # to even like printf; otherwise it is within 1e-15 of the exact value,
+    # and samples that close to a tie are formatted by python
+    slow = huge | (ok & ((s<10.0**(digits-1)) | (s>=10.0**digits)))
+    tie = np.abs(s-np.floor(s)-0.5)<1e-6+1e-15*10.0**digits
+    if tie.any():
+        slow = slow | (tie & ~((k>=0) & (k<=12) & (x.astype(np.float32)==x)))
+    m = m.astype(np.int64)
+
+    # ASCII digits, first one in the lowest byte, and trailing zeros
+    if digits>4:
+        hi = m//10000
+        lo = m-10000*hi
+        d = (np.take(DIGITS4, hi)>>np.uint64(64-8*digits)) | (np.take(DIGITS4, lo)<<np.uint64(8*digits-32))
+        tz = np.where(lo==0, 4+np.take(ZEROS4, hi), np.take(ZEROS4, lo))
+    else:
+        d = np.take(DIGITS4, m)>>np.uint64(32-8*digits)
+        tz = np.take(ZEROS4, m)
+    cls = ((np.clip(e, E_MIN, E_MAX)-E_MIN)*(digits+1)+np.maximum(digits-tz, 1))*2+np.signbit(x)
+    d = d & np.take(masks, cls)
+    shift = np.take(shifts, cls)
+    low = d & ((np.uint64(1)<<shift)-np.uint64(1))
+    d = low | (np.take(pchars, cls)<<shift) | ((d-low)<<np.uint64(8))
+    # the digits (8 bytes at most) go across the two words (in two shifts,
+    # none being by 64 bits)
+    out = np.take(words, cls, axis=0)
+    half = np.take(lo_shifts, cls)
+    out[:, 0] = out[:, 0] | ((d<<half)<<half)
+    half = np.take(hi_shifts, cls)
+    out[:, 1] = out[:, 1] | ((d>>half)>>half)
+
+    for v in [np.nan, np.inf, -np.inf]:
+        same = (x==v) if v==v else np.isnan(x)
+        if same.any():
+            out[same] = text_row(fmt % v)
+    for j in np.flatnonzero(slow):
+        out[j] = text_row(fmt % x[j])
+    return out
+
+# formatted values of all the codes of a channel, by (gain, offset,
+# resolution, digits, prefix)
+CODE_TABLES = {}
+
+def code_table(gain, offset, resolution, digits, prefix):
+    key = (gain, offset, resolution, digits, prefix)
+    if not key in CODE_TABLES:
+        codes = np.arange(-2**(resolution-1), 2**(resolution-1))
+        # samples are float32 values of the codes
+        values = (codes*gain+offset).astype(np.float32)
+        CODE_TABLES[key] = (values, format_samples(values, digits, prefix))
+    return CODE_TABLES[key]
+
+def format_codes(x, gain, offset, resolution, digits, prefix):
+    # ADC samples are codes times the gain, bounded by the resolution: their
+    # words are looked up in a table formatted once. Returns None if the
+    # samples are not exactly those values (e.g. filtered or missing).
+    values, table = code_table(gain, offset, resolution, digits, prefix)
+    with np.errstate(invalid='ignore'):
+        k = np.rint((x-offset)/gain)
+    if not np.all(np.abs(k)<=2**(resolution-1)):
+        return None
+    k = k.astype(np.int64)+2**(resolution-1)
+    if k.max()>=len(table) or not np.array_equal(values[k], x):
+        return None
+    out = np.take(table, k, axis=0)
+    # -0.0 equals 0.0 but is printed differently
+    neg = np.signbit(x) & (x==0)
+    if neg.any():
+        out[neg] = text_row(prefix+"%.*g" % (digits, -0.0))
+    return out
+
+def format_column(x, fmt):
+    # more than 7 digits or a longer separator: each distinct value is
+    # formatted once and the strings are gathered back, unless most values
+    # are distinct
+    u, inv = np.unique(x, return_inverse=True)
+    if 4*len(u) > len(x):
+        return np.array([fmt % v for v in x.tolist()], dtype=object)
+    table = np.array([fmt % v for v in u.tolist()], dtype=object)
+    return table[inv.ravel()]
+
+def format_text_record(data, sep=';', digits=7, lead=True, gains=None, offsets=None, resolution=None):
+    # format a whole record at once: data[k] holds the samples of channel k,
+    # whose codes are scaled by gains[k] and offsets[k] if given. With
+    # lead=True each line starts with the separator, matching the header
+    # line of channel names of the csv files.
+    data = np.asarray(data)
+    nchan, n = data.shape
+    if n==0:
+        return ""
+    digits = max(1, int(digits))
+    if digits>7 or len(sep)>2 or not sep.isascii():
+        fmt = "%."+str(digits)+"g"
+        out = np.empty((n, nchan+1), dtype=object)
+        for k in range(nchan):
+            out[:, k] = format_column(data[k], sep+fmt if (lead or k>0) else fmt)
+        out[:, nchan] = "\n"
+        return "".join(out.ravel().tolist())
+
+    out = np.zeros((n, 2*nchan+1), dtype='<u8')
+    for k in range(nchan):
+        prefix = sep if (lead or k>0) else ""
+        words = None
+        if gains is not None and resolution is not None:
+            words = format_codes(data[k], gains[k], offsets[k], resolution, digits, prefix)
+        if words is None:
+            words = format_samples(data[k], digits, prefix)
+        out[:, 2*k:2*k+2] = words
+    out[:, 2*nchan] = ord('\n')
+    b = out.view(np.uint8).ravel()
+    return np.compress(b!=0, b).tobytes().decode('ascii')
+
+
+def count_scale(rng, resolution):
+    # gain (volts per count) and offset of the integer codes of a channel
+    # with input range +-rng sampled on the given number of bits
+    gain = 2.0*rng/(2**resolution)
+    return gain, 0.0
+
+def count_dtype(resolution):
+    if resolution<=8:
+        return np.dtype('int8')
+    return np.dtype('int16')
+
+def missing_code(dtype):
+    # code of the samples missing from a record (NaN in volts); the lowest
+    # code is reserved for it
+    return np.iinfo(dtype).min
+
+def to_counts(data, gains, offsets, dtype):
+    # convert a record in volts into integer codes, data[k] being scaled
+    # by gains[k] and offsets[k]
+    dtype = np.dtype(dtype)
+    info = np.iinfo(dtype)
+    gains = np.asarray(gains, dtype=np.float64)[:, None]
+    offsets = np.asarray(offsets, dtype=np.float64)[:, None]
+    codes = np.rint((np.asarray(data)-offsets)/gains)
+    np.clip(codes, info.min+1, info.max, out=codes)
+    codes[np.isnan(codes)] = missing_code(dtype)
+    return codes.astype(dtype)
+
+def from_counts(codes, gain, offset=0.0):
+    # volts (float32) of integer codes, NaN for the missing samples
+    codes = np.asarray(codes)
+    x = np.asarray(codes.astype(np.float32)*np.float32(gain)+np.float32(offset))
+    x[codes==missing_code(codes.dtype)] = np.nan
+    if x.ndim==0:
+        return x[()]
+    return x
+
+
+class RawFileWriter():
+    # Raw binary stream: samples are appended, interleaved by channel
+    # (one row per sample), to a preallocated memory-mapped file. The
+    # description of the stream is stored in a JSON sidecar file that is
+    # rewritten when the file is closed.
+    def __init__(self, fname, info, nchan, dtype='float32', prealloc=1<<22):
+        self.fname = fname
+        self.header_name = os.path.splitext(fname)[0]+".json"
+        self.nchan = nchan
+        self.dtype = np.dtype(dtype)
+        self.grow = max(1, int(prealloc))
+        self.n = 0
+        self.nrec = 0
+        self.info = dict(info)
+        self.info["Format"] = "raw"
+        self.info["Dtype"] = self.dtype.str
+        self.info["N_channels"] = nchan
+        self.info["N_samples"] = 0
+        self.info["N_records"] = 0
+        self.capacity = 0
+        self.mm = None
+        self.f = open(fname, 'w+b')
+        self.write_header()
+        self.resize(self.grow)
+
+    def resize(self, capacity):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm = None
+        self.f.truncate(capacity*self.nchan*self.dtype.itemsize)
+        self.capacity = capacity
+        if capacity>0:
+            self.mm = np.memmap(self.f, dtype=self.dtype, mode='r+', shape=(capacity, self.nchan))
+
+    def write(self, data):
+        n = len(data[0])
+        if self.n+n > self.capacity:
+            self.resize(max(self.n+n, self.capacity+self.grow))
+        # transpose into the interleaved rows of the mapped file
+        self.mm[self.n:self.n+n, :] = np.asarray(data).T
+        self.n = self.n+n
+        self.nrec = self.nrec+1
+
+    def write_header(self):
+        self.info["N_samples"] = self.n
+        self.info["N_records"] = self.nrec
+        with open(self.header_name, 'w') as h:
+            json.dump(self.info, h, indent=1)
+
+    def flush(self):
+        if self.mm is not None:
+            self.mm.flush()
+        self.write_header()
+
+    def close(self):
+        # drop the preallocated tail of the file
+        self.resize(self.n)
+        self.write_header()
+        self.f.close()
+
+# per-record index: record number, first sample since the start of the stream,
+# first sample in the file, number of samples, time of the first sample (from
+# the sample clock) and system clock when the record was read
+INDEX_DTYPE = np.dtype([("record", 'int64'), ("sample", 'int64'), ("start", 'int64'),
+                        ("length", 'int64'), ("time", 'float64'), ("clock", 'float64')])
+
+def create_index(group):
+    for name in INDEX_DTYPE.names:
+        if name not in group:
+            group.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(4096,), dtype=INDEX_DTYPE[name])
+
+class RecordIndex():
+    # Rows of the per-record index are kept in memory and appended by blocks,
+    # either to one resizable dataset per field of a HDF5 group, or to a
+    # binary file of INDEX_DTYPE rows (".idx", read with numpy.fromfile).
+    def __init__(self, target, block=64):
+        self.target = target
+        self.block = max(1, int(block))
+        self.rows = np.zeros(self.block, dtype=INDEX_DTYPE)
+        self.n = 0
+        # rows written to the target
+        self.n_flushed = 0
+        self.f = None
+        if isinstance(target, str):
+            self.f = open(target, 'wb')
+        else:
+            create_index(target)
+
+    def add(self, record, sample, start, length, t, clock):
+        self.rows[self.n] = (record, sample, start, length, t, clock)
+        self.n = self.n+1
+        if self.n==self.block:
+            self.flush()
+
+    def flush(self):
+        if self.n==0:
+            return
+        rows = self.rows[:self.n]
+        if self.f is not None:
+            rows.tofile(self.f)
+            self.f.flush()
+        else:
+            r = self.target["record"].shape[0]
+            for name in INDEX_DTYPE.names:
+                dset = self.target[name]
+                dset.resize((r+self.n,))
+                dset[r:] = rows[name]
+        self.n_flushed = self.n_flushed+self.n
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
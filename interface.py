@@ -1,12 +1,15 @@
+import sys
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import ttk
-import libtiepie
-import time
-import os
-import datetime
-import h5py
-import threading
+from engine import StreamEngine, get_backend, FILEEXT_LIST, NEWFILEUNIT_LIST, LAYOUT_LIST, COMPRESSION_LIST, STORAGE_LIST
+from pipeline import POLICY_LIST
+from compress import POSTCOMPRESSION_LIST
+from dsp import FILTER_LIST, OUTPUT_LIST
+from trigger import TRIGGER_LIST
+from multiscope import MultiScope
+from display import envelope_line
 
 class InstrumentBox:
     def __init__(self):
@@ -25,12 +28,14 @@ class ChannelInterface:
         self.scale_list = []
 
 class Interface():
-    def __init__(self):
+    def __init__(self, backend=None):
 
         self.WATCH_BG_COLOR = '#2e332e'
         self.WATCH_FG_COLOR = '#6bff91'
+        self.WATCH_FPS = 10
         
-        # oscilloscope object
+        # acquisition engine and oscilloscope object
+        self.engine = StreamEngine(backend)
         self.scp = None
         self.n_instr = 0
         self.chan_names = []
@@ -38,27 +43,64 @@ class Interface():
         # Create the GUI base
         self.root = tk.Tk()
         self.root.title("TiePie Streaming Interface")
-        self.root.geometry('620x700')
+        self.root.geometry('620x1170')
 
 
         # Key default variables:
-        self.foldername = tk.StringVar(self.root, os.path.expanduser('~'))
-        self.filename = tk.StringVar(self.root, "datastream")
-        fileext_list = [".hdf5", ".csv"]
+        self.foldername = tk.StringVar(self.root, self.engine.foldername)
+        self.filename = tk.StringVar(self.root, self.engine.filename)
+        fileext_list = FILEEXT_LIST
         self.fileext = tk.StringVar(self.root)
         self.fileext.set(fileext_list[0])
+        layout_list = LAYOUT_LIST
+        self.h5layout = tk.StringVar(self.root, layout_list[0])
+        compression_list = COMPRESSION_LIST
+        self.h5compression = tk.StringVar(self.root, compression_list[0])
+        self.textdigits = tk.IntVar(self.root, self.engine.textdigits)
+        storage_list = STORAGE_LIST
+        self.storage = tk.StringVar(self.root, storage_list[0])
+        self.postcompression = tk.StringVar(self.root, POSTCOMPRESSION_LIST[0])
+        self.compresslevel = tk.IntVar(self.root, self.engine.compresslevel)
+        self.compressworkers = tk.IntVar(self.root, self.engine.compressworkers)
+        self.decimation = tk.IntVar(self.root, self.engine.decimation)
+        self.dspfilter = tk.StringVar(self.root, FILTER_LIST[0])
+        self.dspoutput = tk.StringVar(self.root, OUTPUT_LIST[0])
+        self.trigger = tk.StringVar(self.root, TRIGGER_LIST[0])
+        self.triggerlevel = tk.DoubleVar(self.root, self.engine.triggerlevel)
+        self.triggerchans = tk.StringVar(self.root, self.engine.triggerchans)
+        self.pretrigger = tk.DoubleVar(self.root, self.engine.pretrigger)
+        self.posttrigger = tk.DoubleVar(self.root, self.engine.posttrigger)
 
         self.freq = tk.DoubleVar(self.root)
         self.res  = tk.IntVar(self.root)
         self.reclength = tk.IntVar(self.root)
         
         self.newfileperiod = tk.DoubleVar(self.root, 1)
-        timeunit_list = ["s", "min", "h", "d", "infty"]
+        timeunit_list = NEWFILEUNIT_LIST
         self.newfileunit = tk.StringVar(self.root, "infty")
-        self.new_file_per = 0.0
+        self.newfilealign = tk.IntVar(self.root, 0)
+        self.journal = tk.IntVar(self.root, self.engine.journal)
+        self.flushinterval = tk.DoubleVar(self.root, self.engine.flushinterval)
+        self.restart = tk.IntVar(self.root, self.engine.restart)
+        self.summary = tk.IntVar(self.root, self.engine.summary)
+        self.summarybin = tk.DoubleVar(self.root, self.engine.summarybin)
+        self.summarypsd = tk.IntVar(self.root, self.engine.summarypsd)
+        self.triggersta = tk.DoubleVar(self.root, self.engine.triggersta)
+        self.triggerlta = tk.DoubleVar(self.root, self.engine.triggerlta)
+        self.multidev = tk.IntVar(self.root, self.engine.multidev)
+        self.publishhost = tk.StringVar(self.root, self.engine.publishhost)
+        self.publishport = tk.IntVar(self.root, self.engine.publishport)
+
+        self.queuedepth = tk.IntVar(self.root, self.engine.queuedepth)
+        self.queuepolicy = tk.StringVar(self.root, POLICY_LIST[0])
 
-        self.stop = False
         self.watch = False
+        self.watch_latest = None
+        self.watch_lock = threading.Lock()
+        self.statslog = tk.IntVar(self.root, 0)
+        self.perf_text = tk.StringVar(self.root, "Not streaming")
+        self.perf_detail = tk.StringVar(self.root, "")
+        self.publish = tk.IntVar(self.root, 0)
 
         mainframe = ttk.Frame(self.root, padding="10")
         mainframe.grid(column=0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
@@ -74,7 +116,7 @@ class Interface():
         self.root.config(menu=menubar)
 
         # File etc
-        file_frame = ttk.LabelFrame(mainframe, text="File settings", width=590, height=150)
+        file_frame = ttk.LabelFrame(mainframe, text="File settings", width=590, height=535)
         file_frame.grid(column=0, row=0, columnspan=2, sticky=tk.N)
         file_frame.grid_propagate(0)
         
@@ -94,9 +136,107 @@ class Interface():
         ttk.Label(file_frame, text="New file every:").grid(column=0, row=3, pady=5, padx=5, sticky=tk.E)
         self.newfileperiod_entry = ttk.Entry(file_frame, width=14, textvariable=self.newfileperiod)
         self.newfileperiod_entry.grid(column=1, row=3, columnspan=2, padx=5, pady=5, sticky=tk.E)
-        self.newfileunit_list = ttk.OptionMenu(file_frame, self.newfileunit, timeunit_list[4],  *timeunit_list)
+        self.newfileunit_list = ttk.OptionMenu(file_frame, self.newfileunit, timeunit_list[-1],  *timeunit_list)
         self.newfileunit_list.grid(column=3, row=3, padx=5, pady=5, sticky=tk.W)
-        self.newfileunit_list.config(width=4)
+        self.newfileunit_list.config(width=7)
+
+        ttk.Label(file_frame, text="HDF5 layout:").grid(column=4, row=3, pady=5, padx=5, sticky=tk.E)
+        self.h5layout_list = ttk.OptionMenu(file_frame, self.h5layout, layout_list[0], *layout_list)
+        self.h5layout_list.grid(column=5, row=3, padx=5, pady=5)
+        self.h5layout_list.config(width=6)
+
+        ttk.Label(file_frame, text="Write queue depth:").grid(column=0, row=4, pady=5, padx=5, sticky=tk.E)
+        self.queuedepth_entry = ttk.Entry(file_frame, width=14, textvariable=self.queuedepth)
+        self.queuedepth_entry.grid(column=1, row=4, columnspan=2, padx=5, pady=5, sticky=tk.E)
+        self.queuepolicy_list = ttk.OptionMenu(file_frame, self.queuepolicy, POLICY_LIST[0], *POLICY_LIST)
+        self.queuepolicy_list.grid(column=3, row=4, padx=5, pady=5, sticky=tk.W)
+        self.queuepolicy_list.config(width=4)
+
+        ttk.Label(file_frame, text="Compression:").grid(column=4, row=4, pady=5, padx=5, sticky=tk.E)
+        self.h5compression_list = ttk.OptionMenu(file_frame, self.h5compression, compression_list[0], *compression_list)
+        self.h5compression_list.grid(column=5, row=4, padx=5, pady=5)
+        self.h5compression_list.config(width=6)
+
+        ttk.Label(file_frame, text="CSV/TSV digits:").grid(column=0, row=5, pady=5, padx=5, sticky=tk.E)
+        self.textdigits_entry = ttk.Entry(file_frame, width=14, textvariable=self.textdigits)
+        self.textdigits_entry.grid(column=1, row=5, columnspan=2, padx=5, pady=5, sticky=tk.E)
+
+        ttk.Label(file_frame, text="Store samples as:").grid(column=4, row=5, pady=5, padx=5, sticky=tk.E)
+        self.storage_list = ttk.OptionMenu(file_frame, self.storage, storage_list[0], *storage_list)
+        self.storage_list.grid(column=5, row=5, padx=5, pady=5)
+        self.storage_list.config(width=6)
+
+        ttk.Label(file_frame, text="Compress closed files:").grid(column=0, row=6, pady=5, padx=5, sticky=tk.E)
+        self.postcompression_list = ttk.OptionMenu(file_frame, self.postcompression, POSTCOMPRESSION_LIST[0], *POSTCOMPRESSION_LIST)
+        self.postcompression_list.grid(column=1, row=6, columnspan=2, padx=5, pady=5, sticky=tk.E)
+        self.postcompression_list.config(width=6)
+
+        ttk.Label(file_frame, text="Level:").grid(column=4, row=6, pady=5, padx=5, sticky=tk.E)
+        self.compresslevel_entry = ttk.Entry(file_frame, width=8, textvariable=self.compresslevel)
+        self.compresslevel_entry.grid(column=5, row=6, padx=5, pady=5)
+
+        ttk.Checkbutton(file_frame, text="Align new files on the clock (e.g. on the hour)", variable=self.newfilealign).grid(column=0, row=7, columnspan=4, padx=5, pady=5, sticky=tk.W)
+
+        ttk.Label(file_frame, text="Decimate by:").grid(column=0, row=8, pady=5, padx=5, sticky=tk.E)
+        self.decimation_entry = ttk.Entry(file_frame, width=14, textvariable=self.decimation)
+        self.decimation_entry.grid(column=1, row=8, columnspan=2, padx=5, pady=5, sticky=tk.E)
+        self.dspfilter_list = ttk.OptionMenu(file_frame, self.dspfilter, FILTER_LIST[0], *FILTER_LIST)
+        self.dspfilter_list.grid(column=3, row=8, padx=5, pady=5, sticky=tk.W)
+        self.dspfilter_list.config(width=4)
+
+        ttk.Label(file_frame, text="Decimated output:").grid(column=4, row=8, pady=5, padx=5, sticky=tk.E)
+        self.dspoutput_list = ttk.OptionMenu(file_frame, self.dspoutput, OUTPUT_LIST[0], *OUTPUT_LIST)
+        self.dspoutput_list.grid(column=5, row=8, padx=5, pady=5)
+        self.dspoutput_list.config(width=6)
+
+        ttk.Label(file_frame, text="Trigger:").grid(column=0, row=9, pady=5, padx=5, sticky=tk.E)
+        self.trigger_list = ttk.OptionMenu(file_frame, self.trigger, TRIGGER_LIST[0], *TRIGGER_LIST)
+        self.trigger_list.grid(column=1, row=9, columnspan=2, padx=5, pady=5, sticky=tk.E)
+        self.trigger_list.config(width=8)
+
+        ttk.Label(file_frame, text="Level (V or STA/LTA):").grid(column=3, row=9, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.triggerlevel_entry = ttk.Entry(file_frame, width=8, textvariable=self.triggerlevel)
+        self.triggerlevel_entry.grid(column=5, row=9, padx=5, pady=5)
+
+        ttk.Label(file_frame, text="Pre/post-trigger (s):").grid(column=0, row=10, pady=5, padx=5, sticky=tk.E)
+        self.pretrigger_entry = ttk.Entry(file_frame, width=6, textvariable=self.pretrigger)
+        self.pretrigger_entry.grid(column=1, row=10, padx=5, pady=5)
+        self.posttrigger_entry = ttk.Entry(file_frame, width=6, textvariable=self.posttrigger)
+        self.posttrigger_entry.grid(column=2, row=10, padx=5, pady=5)
+
+        ttk.Label(file_frame, text="Trigger channels:").grid(column=3, row=10, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.triggerchans_entry = ttk.Entry(file_frame, width=8, textvariable=self.triggerchans)
+        self.triggerchans_entry.grid(column=5, row=10, padx=5, pady=5)
+
+        ttk.Checkbutton(file_frame, text="Journaled", variable=self.journal).grid(column=0, row=11, padx=5, pady=5, sticky=tk.W)
+        ttk.Label(file_frame, text="Flush every (s):").grid(column=1, row=11, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.flushinterval_entry = ttk.Entry(file_frame, width=6, textvariable=self.flushinterval)
+        self.flushinterval_entry.grid(column=3, row=11, padx=5, pady=5)
+        ttk.Checkbutton(file_frame, text="Restart on overflow", variable=self.restart).grid(column=4, row=11, columnspan=2, padx=5, pady=5, sticky=tk.E)
+
+        ttk.Checkbutton(file_frame, text="Summary", variable=self.summary).grid(column=0, row=12, padx=5, pady=5, sticky=tk.W)
+        ttk.Label(file_frame, text="Bin (s):").grid(column=1, row=12, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.summarybin_entry = ttk.Entry(file_frame, width=6, textvariable=self.summarybin)
+        self.summarybin_entry.grid(column=3, row=12, padx=5, pady=5)
+        ttk.Label(file_frame, text="PSD length:").grid(column=4, row=12, pady=5, padx=5, sticky=tk.E)
+        self.summarypsd_entry = ttk.Entry(file_frame, width=8, textvariable=self.summarypsd)
+        self.summarypsd_entry.grid(column=5, row=12, padx=5, pady=5)
+
+        ttk.Checkbutton(file_frame, text="Open all devices", variable=self.multidev).grid(column=0, row=13, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        ttk.Label(file_frame, text="Publish host/port:").grid(column=2, row=13, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.publishhost_entry = ttk.Entry(file_frame, width=10, textvariable=self.publishhost)
+        self.publishhost_entry.grid(column=4, row=13, padx=5, pady=5)
+        self.publishport_entry = ttk.Entry(file_frame, width=8, textvariable=self.publishport)
+        self.publishport_entry.grid(column=5, row=13, padx=5, pady=5)
+
+        ttk.Label(file_frame, text="STA/LTA (s):").grid(column=0, row=14, pady=5, padx=5, sticky=tk.E)
+        self.triggersta_entry = ttk.Entry(file_frame, width=6, textvariable=self.triggersta)
+        self.triggersta_entry.grid(column=1, row=14, padx=5, pady=5)
+        self.triggerlta_entry = ttk.Entry(file_frame, width=6, textvariable=self.triggerlta)
+        self.triggerlta_entry.grid(column=2, row=14, padx=5, pady=5)
+        ttk.Label(file_frame, text="Compress workers:").grid(column=3, row=14, columnspan=2, pady=5, padx=5, sticky=tk.E)
+        self.compressworkers_entry = ttk.Entry(file_frame, width=8, textvariable=self.compressworkers)
+        self.compressworkers_entry.grid(column=5, row=14, padx=5, pady=5)
         
         # Main interaction commands
         op_frame = ttk.LabelFrame(mainframe, text="Operations", width=590, height=70)
@@ -163,6 +303,15 @@ class Interface():
                 self.instr_list[i].channels[c].scale_entry.grid(column=3, row=c, padx=5, pady=5)
                 self.instr_list[i].channels[c].scale_entry.config(width=5)
 
+        # Streaming performance
+        perf_frame = ttk.LabelFrame(mainframe, text="Performance", width=590, height=75)
+        perf_frame.grid(column=0, row=5, columnspan=2)
+        perf_frame.grid_propagate(0)
+        ttk.Label(perf_frame, textvariable=self.perf_text, width=70).grid(column=0, row=0, padx=5, sticky=tk.W)
+        ttk.Label(perf_frame, textvariable=self.perf_detail, width=70).grid(column=0, row=1, padx=5, sticky=tk.W)
+        ttk.Checkbutton(perf_frame, text="Stats log", variable=self.statslog).grid(column=1, row=0, padx=5, sticky=tk.E)
+        ttk.Checkbutton(perf_frame, text="Publish", variable=self.publish).grid(column=1, row=1, padx=5, sticky=tk.E)
+
         # disable everything by default
         self.disable_all_instr()
 
@@ -178,158 +327,172 @@ class Interface():
         self.foldername.set(filedialog.askdirectory())
         
     def open_dev(self):
-        print("Update device list...")
-        libtiepie.device_list.update()
-        print("Found ", len(libtiepie.device_list), " devices")
-        devlist = libtiepie.device_list
-        ids = [device._get_product_id() for device in devlist]
-        i = 0
-        try:
-            ind = ids.index(2)
-            print("Found combined oscilloscope device")
-            device = devlist[ind]
-            if device.can_open(libtiepie.DEVICETYPE_OSCILLOSCOPE):
-                print("Opening", device.name, "#", device.serial_number)
-                self.scp = device.open_oscilloscope()
-                sn = device.contained_serial_numbers
-                print("Contained serial numbers:")
-                for _sn in sn:
-                    print(_sn)
-                    self.instr_list[i].enabled=True
-                    self.instr_list[i].frame.configure(text="Serial #"+str(_sn))
-                    for item in self.instr_list[i].frame.winfo_children():
-                        item.configure(state=tk.NORMAL)
-                            
-                    i = i+1
-
-                self.n_instr = i+1
-            else:
-                print("Cannot open device")
-                return
-        except:
-            print("Single device")
-            ind = 0
-            device = devlist[ind]
-            if device.can_open(libtiepie.DEVICETYPE_OSCILLOSCOPE):
-                print("Opening", device.name, "#", device.serial_number)
-                self.scp = device.open_oscilloscope()
-                sn = device.serial_number
-                self.instr_list[i].enabled=True
-                self.instr_list[i].frame.configure(text="Serial #"+str(sn))
-                for item in self.instr_list[i].frame.winfo_children():
-                    item.configure(state=tk.NORMAL)
+        self.engine.multidev = self.multidev.get()
+        serials = self.engine.open_dev()
+        self.scp = self.engine.scp
+        self.n_instr = len(serials)
+        for i, sn in enumerate(serials):
+            self.instr_list[i].enabled=True
+            self.instr_list[i].frame.configure(text="Serial #"+str(sn))
+            for item in self.instr_list[i].frame.winfo_children():
+                item.configure(state=tk.NORMAL)
 
-                self.n_instr = i+1      
-            else:
-                print("Cannot open device")
-                return
-                
-        if self.n_instr>0:
-            if self.scp.measure_modes & libtiepie.MM_STREAM:
-                self.enable_options()
-            else:
-                print("Device does not support streaming mode")
-        else:
-            print("Oscilloscope(s) cannot be opened")
+        if self.n_instr>0 and self.engine.streaming:
+            self.enable_options()
 
-            
+    def update_engine(self):
+        # copy the GUI settings into the engine
+        eng = self.engine
+        eng.foldername = self.foldername.get()
+        eng.filename = self.filename.get()
+        eng.fileext = self.fileext.get()
+        eng.newfileperiod = self.newfileperiod.get()
+        eng.newfileunit = self.newfileunit.get()
+        eng.newfilealign = self.newfilealign.get()
+        eng.journal = self.journal.get()
+        eng.flushinterval = self.flushinterval.get()
+        eng.restart = self.restart.get()
+        eng.summary = self.summary.get()
+        eng.summarybin = self.summarybin.get()
+        eng.summarypsd = self.summarypsd.get()
+        eng.freq = self.freq.get()
+        eng.res = self.res.get()
+        eng.reclength = self.reclength.get()
+        for _i in [0,1,2,3]:
+            for _c in [0,1,2,3]:
+                c = 4*_i+_c
+                eng.chan_enabled[c] = self.instr_list[_i].channels[_c].enabled_var.get()
+                eng.chan_names[c] = self.instr_list[_i].channels[_c].name_var.get()
+                eng.chan_ranges[c] = self.instr_list[_i].channels[_c].scale_var.get()
+        eng.queuedepth = self.queuedepth.get()
+        eng.queuepolicy = self.queuepolicy.get()
+        eng.h5layout = self.h5layout.get()
+        eng.h5compression = self.h5compression.get()
+        eng.textdigits = self.textdigits.get()
+        eng.storage = self.storage.get()
+        eng.statslog = self.statslog.get()
+        eng.publish = self.publish.get()
+        eng.postcompression = self.postcompression.get()
+        eng.compresslevel = self.compresslevel.get()
+        eng.compressworkers = self.compressworkers.get()
+        eng.triggersta = self.triggersta.get()
+        eng.triggerlta = self.triggerlta.get()
+        eng.multidev = self.multidev.get()
+        eng.publishhost = self.publishhost.get()
+        eng.publishport = self.publishport.get()
+        eng.decimation = self.decimation.get()
+        eng.dspfilter = self.dspfilter.get()
+        eng.dspoutput = self.dspoutput.get()
+        eng.trigger = self.trigger.get()
+        eng.triggerlevel = self.triggerlevel.get()
+        eng.triggerchans = self.triggerchans.get()
+        eng.pretrigger = self.pretrigger.get()
+        eng.posttrigger = self.posttrigger.get()
+
+    def update_gui(self):
+        # copy the engine settings into the GUI
+        eng = self.engine
+        self.foldername.set(eng.foldername)
+        self.filename.set(eng.filename)
+        self.fileext.set(eng.fileext)
+        self.newfileperiod.set(eng.newfileperiod)
+        self.newfileunit.set(eng.newfileunit)
+        self.newfilealign.set(eng.newfilealign)
+        self.journal.set(eng.journal)
+        self.flushinterval.set(eng.flushinterval)
+        self.restart.set(eng.restart)
+        self.summary.set(eng.summary)
+        self.summarybin.set(eng.summarybin)
+        self.summarypsd.set(eng.summarypsd)
+        self.freq.set(eng.freq)
+        self.res.set(eng.res)
+        self.reclength.set(eng.reclength)
+        for _i in [0,1,2,3]:
+            for _c in [0,1,2,3]:
+                c = 4*_i+_c
+                self.instr_list[_i].channels[_c].enabled_var.set(eng.chan_enabled[c])
+                self.instr_list[_i].channels[_c].name_var.set(eng.chan_names[c])
+                self.instr_list[_i].channels[_c].scale_var.set(eng.chan_ranges[c])
+        self.queuedepth.set(eng.queuedepth)
+        self.queuepolicy.set(eng.queuepolicy)
+        self.h5layout.set(eng.h5layout)
+        self.h5compression.set(eng.h5compression)
+        self.textdigits.set(eng.textdigits)
+        self.storage.set(eng.storage)
+        self.statslog.set(eng.statslog)
+        self.publish.set(eng.publish)
+        self.postcompression.set(eng.postcompression)
+        self.compresslevel.set(eng.compresslevel)
+        self.compressworkers.set(eng.compressworkers)
+        self.triggersta.set(eng.triggersta)
+        self.triggerlta.set(eng.triggerlta)
+        self.multidev.set(eng.multidev)
+        self.publishhost.set(eng.publishhost)
+        self.publishport.set(eng.publishport)
+        self.decimation.set(eng.decimation)
+        self.dspfilter.set(eng.dspfilter)
+        self.dspoutput.set(eng.dspoutput)
+        self.trigger.set(eng.trigger)
+        self.triggerlevel.set(eng.triggerlevel)
+        self.triggerchans.set(eng.triggerchans)
+        self.pretrigger.set(eng.pretrigger)
+        self.posttrigger.set(eng.posttrigger)
 
     def arm_dev(self):
-        print("Arm device...")
-        # set scope parameters:
-        self.scp.sample_rate = self.freq.get()
-        self.scp.resolution = self.res.get()
-        self.scp.record_length = self.reclength.get()
-        self.scp.measure_mode = libtiepie.MM_STREAM
+        self.update_engine()
+        self.engine.arm_dev()
 
         # read it back to check:
-        self.freq.set(self.scp.sample_rate)
-        self.res.set(self.scp.resolution)
-        self.reclength.set(self.scp.record_length)
-        
-        for c, chan in enumerate(self.scp.channels):
-            _c = c%4
-            _i = c//4
-            chan.enabled = self.instr_list[_i].channels[_c].enabled_var.get()
-            chan.range = self.instr_list[_i].channels[_c].scale_var.get()
-            chan.coupling = libtiepie.CK_DCV
-
-    def compute_period(self, value, unit):
-        if unit=='s':
-            return value
-        elif unit=='min':
-            return value*60
-        elif unit=='h':
-            return value*3600
-        elif unit=='d':
-            return value*3600*24
+        self.freq.set(self.engine.freq)
+        self.res.set(self.engine.res)
+        self.reclength.set(self.engine.reclength)
 
     def start_streaming(self):
-        self.arm_dev()
+        self.update_engine()
         self.disable_all_instr()
 
         self.arm_button.configure(state=tk.DISABLED)
         self.start_button.configure(text="Stop", command = self.stop_streaming)
 
-        self.new_file_per = self.compute_period(self.newfileperiod.get(), self.newfileunit.get())
-        self.stop = False
-
-        self.run_th = threading.Thread(target=self.run_streaming)
-        self.run_th.start()
-        #self.run_streaming()
-
-    def run_streaming(self):
-        
-        fname = os.path.join(self.foldername.get(), self.filename.get())
-        okchans = self.chan_indices()
         self.chan_names = self.get_chan_names()
-
-        count = 0
-        fcount = 0
-        timer = time.time()
-        
-        print("Acquiring on channels:", okchans)
-
-        if (self.newfileunit.get()!="infty"):
-            fullfilename = fname+str(fcount).rjust(6,'0')+self.fileext.get()
-        else:
-            fullfilename = fname+self.fileext.get()
-
-        print("Make new file:", fullfilename)
-        file = self.init_file(fullfilename)
-
-        self.scp.start()
-
-        while not self.stop:
-            print("Data chunk", count)
-            
-            while not (self.scp.is_data_ready or self.scp.is_data_overflow):
-                self.root.after(10)
-                
-            if self.scp.is_data_overflow:
-                print("Data overflow!")
-                break
-
-            data = self.scp.get_data()
-            self.write_data(data, okchans, count, file)
-            #print("... data written to", file.name)
-
-            count = count+1
-
-            if self.watch:
-                self.root.after(0, self.show_data, data, okchans)
-
-            if (self.newfileunit.get()!="infty"):
-                if ((time.time() - timer) >= self.new_file_per):
-                    file.close()
-                    fcount = fcount+1
-                    fullfilename = fname+str(fcount).rjust(6,'0')+self.fileext.get()
-                    print("Make new file:", fullfilename)
-                    file = self.init_file(fullfilename)
-                    timer = time.time()
-            
-        file.close()
-        self.scp.stop()
+        self.engine.on_data = self.on_data
+        self.engine.start_streaming()
+        self.root.after(500, self.update_perf)
+        self.freq.set(self.engine.freq)
+        self.res.set(self.engine.res)
+        self.reclength.set(self.engine.reclength)
+
+    def update_perf(self):
+        # refresh the performance panel from the last snapshot of the monitor
+        mon = self.engine.monitor
+        if mon is not None and len(mon.last)>0:
+            snap = mon.last
+            self.perf_text.set(mon.status_line(snap))
+            detail = ""
+            for key, label in [("wait_ms", "wait"), ("get_ms", "get_data"), ("write_ms", "write"), ("rotate_ms", "rotation")]:
+                if key in snap:
+                    detail = detail+label+" "+str(round(snap[key],2))+" ms  "
+            detail = detail+"(record "+str(round(snap["record_duration_ms"],2))+" ms)"
+            if self.engine.publisher is not None:
+                detail = detail+"  subscribers: "+str(self.engine.publisher.stats()["subscribers"])
+            if isinstance(self.engine.scp, MultiScope):
+                # records dropped by each device while waiting for the others
+                detail = detail+"  device drops: "+"/".join([str(st["dropped"]) for st in self.engine.scp.stats()])
+            self.perf_detail.set(detail)
+        if self.engine.run_th is not None and self.engine.run_th.is_alive():
+            self.root.after(500, self.update_perf)
+
+    def on_data(self, data, okchans, release):
+        # called from the acquisition thread: only the latest record is kept,
+        # older ones not yet displayed are dropped and their buffer released
+        if not self.watch:
+            release()
+            return
+        with self.watch_lock:
+            old = self.watch_latest
+            self.watch_latest = (data, okchans, release)
+        if old is not None:
+            old[2]()
 
     def open_watch(self):
         self.watch = True
@@ -346,39 +509,40 @@ class Interface():
             self.plot_canvas[i].grid(column=i//8, row=i%8, padx=5, pady=5)
             self.plot_line_tag.append(self.plot_canvas[i].create_line([(0,50),(400,50)], fill=self.WATCH_FG_COLOR, width=2))
             self.plot_text.append(self.plot_canvas[i].create_text(1,1,text="", anchor=tk.NW, fill=self.WATCH_FG_COLOR))
-
-    # Where is create_line and create_text?
+        self.refresh_watch()
+
+    def refresh_watch(self):
+        # redraw at a fixed frame rate, from the main thread
+        if not self.watch:
+            return
+        with self.watch_lock:
+            latest = self.watch_latest
+            self.watch_latest = None
+        if latest is not None:
+            self.show_data(latest[0], latest[1])
+            latest[2]()
+        self.root.after(int(1000/self.WATCH_FPS), self.refresh_watch)
 
     def close_watch(self):
         self.watch = False
+        with self.watch_lock:
+            latest = self.watch_latest
+            self.watch_latest = None
+        if latest is not None:
+            latest[2]()
         self.watch_button.configure(text="Watch!", command = self.open_watch)
         self.watch_window.update()
         self.watch_window.destroy()
 
     def show_data(self, data, ch):
+        # data[k] holds the samples of channel ch[k]
         for k,c in enumerate(ch):
-            ymin = min(data[c])
-            ymax = max(data[c])
-            stepsz = max(1, len(data[c])//400)
-            subdata = data[c][::stepsz]
-            line = []
-            for i in range(len(subdata)):
-                line.append(400*i/len(subdata))
-                line.append(20+80*(-(subdata[i]-ymin)/(1e-12 + ymax-ymin) +1))
-
-            #self.plot_canvas[k].coords(self.plot_line_tag[k], [line[0],line[1],line[99],line[100],line[-2],line[-1]])
+            # min/max envelope over the 400 pixel columns of the canvas
+            line, ymin, ymax = envelope_line(data[k], 400, 100)
             self.plot_canvas[k].coords(self.plot_line_tag[k], line) 
-            #(line, fill=self.WATCH_FG_COLOR, width=2)
             self.plot_canvas[k].itemconfigure(self.plot_text[k], text=self.chan_names[c]+"  range:"+str(round(ymin,4))+" "+str(round(ymax,4)))#(1,1,text=self.chan_names[c]+"  range:"+str(round(ymin,4))+" "+str(round(ymax,4)), anchor=tk.NW, fill=self.WATCH_FG_COLOR)
 
 
-    def chan_indices(self):
-        ind = []
-        for c, chan in enumerate(self.scp.channels):
-            if chan.enabled:
-                ind.append(c)
-        return ind
-
     def get_chan_names(self):
         cnames=[]
         for i in [0,1,2,3]:
@@ -388,64 +552,14 @@ class Interface():
         return cnames
     
 
-    def init_file(self, fname):
-        if self.fileext.get()==".csv":
-            f = open(fname, 'w')
-            f.write("Date:"+str(datetime.datetime.now())+os.linesep)
-            f.write("Sampling freq:"+str(self.scp.sample_rate)+os.linesep)
-            f.write("Resolution:"+str(self.scp.resolution)+os.linesep)
-            f.write("Record length:"+str(self.scp.record_length)+os.linesep)
-            f.write(os.linesep)
-            for c, chan in enumerate(self.scp.channels):
-                _c = c%4
-                _i = c//4
-                if chan.enabled:
-                    f.write(';'+self.instr_list[_i].channels[_c].name_var.get())
-
-            f.write(os.linesep)
-
-            return f
-
-        elif self.fileext.get()==".hdf5":
-            f = h5py.File(fname,'w')
-            info = f.create_group("Info")
-            info.attrs["Date"] = str(datetime.datetime.now())
-            info.attrs["Sampling_freq"] = self.scp.sample_rate
-            info.attrs["Resolution"] = self.scp.resolution
-            info.attrs["Record_length"] = self.scp.record_length
-            for c, chan in enumerate(self.scp.channels):
-                _c = c%4
-                _i = c//4
-                if chan.enabled:
-                    info.attrs["chan"+str(c+1).rjust(2,'0')] = self.instr_list[_i].channels[_c].name_var.get()
-
-            return f
-            
-        
-    def write_data(self, data, ch, count, f):
-        if self.fileext.get()==".csv":
-            for i in range(len(data[ch[0]])):
-                for j in range(len(ch)):
-                        f.write(';'+str(data[ch[j]][i]))
-                f.write(os.linesep)
-
-        elif self.fileext.get()==".hdf5":
-            grp = f.create_group("chunk_"+str(count).rjust(8,'0'))
-            grp.attrs["Date"] = str(datetime.datetime.now())
-            for c in ch:
-                grp.create_dataset("chan"+str(c+1).rjust(2,'0'), data=data[c])
-
-        
     def stop_streaming(self):
         try:
-            self.stop = True
-            self.run_th.join(0)
-            self.run_th = None
+            self.engine.stop_streaming()
             
             self.arm_button.configure(state=tk.NORMAL)
             self.start_button.configure(text="Stream!", command = self.start_streaming)
             self.enable_options()
-            for i in range(self.n_instr-1):
+            for i in range(self.n_instr):
                 for item in self.instr_list[i].frame.winfo_children():
                     item.configure(state=tk.NORMAL)
 
@@ -487,7 +601,7 @@ class Interface():
             
 
     def close_dev(self):
-        print("Close devices...")
+        self.engine.close_dev()
         self.scp = None
         self.open_button.configure(text="Open DEV", command=self.open_dev)
         self.arm_button.configure(state=tk.DISABLED)
@@ -495,23 +609,8 @@ class Interface():
         self.disable_all_instr()
             
     def save_config_file(self, filename):
-        print("Save config file as", filename, "...")
-        f = open(filename, "w", newline='\n')
-        f.write("Date:"+str(datetime.datetime.now())+'\n')
-        f.write("File format:"+self.fileext.get()+'\n')
-        f.write("New file period:"+str(self.newfileperiod.get())+'\n')
-        f.write("New file unit:"+str(self.newfileunit.get())+'\n')
-        f.write("Sampling freq:"+str(self.freq.get())+'\n')
-        f.write("Resolution:"+str(self.res.get())+'\n')
-        f.write("Record length:"+str(self.reclength.get())+'\n')
-        for _i in [0,1,2,3]:
-            for _c in [0,1,2,3]:
-                name = "Instr"+str(_i+1)+"_Chan"+str(_c+1)+":"
-                f.write(name+str(self.instr_list[_i].channels[_c].enabled_var.get())+'\n')
-                f.write(name+self.instr_list[_i].channels[_c].name_var.get()+'\n')
-                f.write(name+str(self.instr_list[_i].channels[_c].scale_var.get())+'\n')
-            
-        f.close()
+        self.update_engine()
+        self.engine.save_config_file(filename)
 
     def save_config_file_dialog(self):
         fname = filedialog.asksaveasfilename(initialdir=self.foldername.get(), initialfile=self.filename.get()+"_config", defaultextension=".txt")
@@ -519,36 +618,22 @@ class Interface():
             self.save_config_file(fname)
 
     def open_config_file(self, filename):
-        print("Open config file ", filename, "...")
-        f = open(filename, "r")
-        lines = f.readlines()
-        f.close()
-        self.fileext.set(lines[1].split(':')[1].strip("\n"))
-        self.newfileperiod.set(float(lines[2].split(':')[1]))
-        self.newfileunit.set(lines[3].split(':')[1].strip("\n"))
-        self.freq.set(float(lines[4].split(':')[1]))
-        self.res.set(int(lines[5].split(':')[1]))
-        self.reclength.set(int(lines[6].split(':')[1]))
-        #f.write("Date:"+str(datetime.datetime.now())+os.linesep)
-        #f.write("Sampling freq:"+str(self.freq.get())+os.linesep)
-        #f.write("Resolution:"+str(self.res.get())+os.linesep)
-        n=7
-        for _i in [0,1,2,3]:
-            for _c in [0,1,2,3]:
-                en_val = int(lines[n].split(':')[1])
-                name_val = lines[n+1].split(':')[1].strip("\n\r")
-                scale_val = float(lines[n+2].split(':')[1])
-                self.instr_list[_i].channels[_c].enabled_var.set(en_val)
-                self.instr_list[_i].channels[_c].name_var.set(name_val)
-                self.instr_list[_i].channels[_c].scale_var.set(scale_val)
-                n = n+3
+        self.engine.open_config_file(filename)
+        self.update_gui()
 
     def open_config_file_dialog(self):
         fname = filedialog.askopenfilename(initialdir=self.foldername.get(), defaultextension=".txt")
         if len(fname)>0:
             self.open_config_file(fname)
 
-inter = Interface()
-# Run gui
-inter.root.mainloop()
+if __name__ == "__main__":
+    backend = None
+    if "--simulate" in sys.argv:
+        # 4 simulated instruments combined, no hardware needed
+        backend = get_backend("simulator")
+        backend.configure(n_instr=4)
+    inter = Interface(backend)
+    # Run gui
+    inter.root.mainloop()
+
 
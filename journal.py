@@ -0,0 +1,131 @@
+import argparse
+import glob
+import json
+import os
+import h5py
+import numpy as np
+from formats import INDEX_DTYPE
+
+# Journal of the files being written: at every flush, the state of the file
+# (samples, index rows and bytes written) is committed to <file>.journal,
+# which is removed once the file is closed. After a crash, the files that
+# still have a journal are brought back to their last committed state.
+
+class Journal():
+    def __init__(self, fname):
+        self.fname = fname
+        self.name = fname+".journal"
+        self.commit({"samples": 0, "rows": 0, "bytes": 0})
+
+    def commit(self, state):
+        state = dict(state)
+        state["file"] = os.path.basename(self.fname)
+        with open(self.name+".tmp", 'w') as h:
+            json.dump(state, h)
+        os.replace(self.name+".tmp", self.name)
+
+    def close(self):
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+def recover_hdf5(fname, state):
+    # files of the journaled mode are written in SWMR mode, and can be read
+    # back up to the last flush; the committed part is copied to a new file
+    n = state["samples"]
+    rows = state["rows"]
+    tmpname = fname+".tmp"
+    with h5py.File(fname, 'r', swmr=True) as src, h5py.File(tmpname, 'w') as dst:
+        for key, val in src.attrs.items():
+            dst.attrs[key] = val
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Group):
+                grp = dst.require_group(name)
+                for key, val in obj.attrs.items():
+                    grp.attrs[key] = val
+            else:
+                m = rows if name.startswith("Index/") else n
+                m = min(m, obj.shape[0])
+                opts = {}
+                if obj.compression is not None:
+                    opts = {"compression": obj.compression, "compression_opts": obj.compression_opts, "shuffle": obj.shuffle}
+                dset = dst.create_dataset(name, data=obj[:m], maxshape=(None,), chunks=obj.chunks, **opts)
+                for key, val in obj.attrs.items():
+                    dset.attrs[key] = val
+        src.visititems(visit)
+    os.replace(tmpname, fname)
+
+def recover_raw(fname, state):
+    base = os.path.splitext(fname)[0]
+    with open(base+".json", 'r') as h:
+        info = json.load(h)
+    row = np.dtype(info["Dtype"]).itemsize*info["N_channels"]
+    with open(fname, 'r+b') as f:
+        f.truncate(state["samples"]*row)
+    info["N_samples"] = state["samples"]
+    info["N_records"] = state["rows"]
+    with open(base+".json", 'w') as h:
+        json.dump(info, h, indent=1)
+    if os.path.exists(base+".idx"):
+        with open(base+".idx", 'r+b') as f:
+            f.truncate(state["rows"]*INDEX_DTYPE.itemsize)
+
+def recover_text(fname, state):
+    with open(fname, 'r+b') as f:
+        f.truncate(state["bytes"])
+
+def remove_file(fname):
+    base = os.path.splitext(fname)[0]
+    names = [fname]
+    if fname.endswith(".bin"):
+        names = names+[base+".json", base+".idx"]
+    for name in names:
+        if os.path.exists(name):
+            os.remove(name)
+
+def recover_file(journal_name):
+    # returns the name of the recovered file, or None if it was removed
+    with open(journal_name, 'r') as h:
+        state = json.load(h)
+    fname = os.path.join(os.path.dirname(journal_name), state["file"])
+    if not os.path.exists(fname):
+        os.remove(journal_name)
+        return None
+    if state["samples"]==0:
+        # opened in advance, or nothing committed yet
+        remove_file(fname)
+        os.remove(journal_name)
+        return None
+    ext = os.path.splitext(fname)[1]
+    if ext==".hdf5":
+        recover_hdf5(fname, state)
+    elif ext==".bin":
+        recover_raw(fname, state)
+    else:
+        recover_text(fname, state)
+    os.remove(journal_name)
+    return fname
+
+def recover_folder(folder, name=""):
+    recovered = []
+    for journal_name in sorted(glob.glob(os.path.join(folder, glob.escape(name)+"*.journal"))):
+        try:
+            fname = recover_file(journal_name)
+        except Exception as e:
+            print("Cannot recover", journal_name, ":", e)
+            continue
+        if fname is not None:
+            print("Recovered", fname)
+            recovered.append(fname)
+    return recovered
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Recover the files left by an interrupted recording.")
+    parser.add_argument("folder")
+    parser.add_argument("name", nargs="?", default="", help="file base name (default: all)")
+    opts = parser.parse_args(args)
+    recover_folder(opts.folder, opts.name)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
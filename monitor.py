@@ -0,0 +1,155 @@
+import collections
+import json
+import threading
+import time
+
+class StreamMonitor():
+    # Per-record timings of the streaming loop (wait for data, get_data,
+    # hand over to the write queue) and of the writer (file rotation, write),
+    # summarized over a rolling window into throughput, load and predicted
+    # headroom. Snapshots are kept for the GUI and can be appended as JSON
+    # lines to a log file.
+    def __init__(self, pipe, nchan, record_length, sample_rate, window=10.0, interval=1.0, logname=None, verbose=True):
+        self.pipe = pipe
+        self.nchan = nchan
+        self.record_length = record_length
+        self.sample_rate = sample_rate
+        self.period = record_length/sample_rate
+        self.window = window
+        self.interval = interval
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.acq = collections.deque()
+        self.wrt = collections.deque()
+        self.clk = collections.deque()
+        self.n_rotations = 0
+        self.t_start = time.time()
+        self.t_last = self.t_start
+        self.last = {}
+        self.log = None
+        if logname is not None:
+            self.log = open(logname, 'a', buffering=1)
+
+    def add_acq(self, count, t_wait, t_get, t_put, queued):
+        now = time.time()
+        with self.lock:
+            self.acq.append((now, count, t_wait, t_get, t_put, queued))
+            self.trim(self.acq, now)
+        if now-self.t_last >= self.interval:
+            self.t_last = now
+            self.publish()
+
+    def add_write(self, count, t_write, t_rotate):
+        now = time.time()
+        with self.lock:
+            self.wrt.append((now, count, t_write, t_rotate))
+            if t_rotate>0:
+                self.n_rotations = self.n_rotations+1
+            self.trim(self.wrt, now)
+
+    def add_clock(self, t_sample, clock):
+        # time of the end of the last record from the sample clock, and system
+        # time when it was read: their difference is the read latency plus
+        # the drift of the sample clock
+        with self.lock:
+            self.clk.append((clock, clock-t_sample))
+            self.trim(self.clk, clock)
+
+    def trim(self, items, now):
+        while len(items)>1 and now-items[0][0] > self.window:
+            items.popleft()
+
+    def snapshot(self):
+        with self.lock:
+            acq = list(self.acq)
+            wrt = list(self.wrt)
+            clk = list(self.clk)
+            n_rot = self.n_rotations
+        cnt = self.pipe.counters() if self.pipe is not None else {}
+        snap = {"time": time.time(), "elapsed": time.time()-self.t_start,
+                "records": cnt.get("acquired", 0), "written": cnt.get("written", 0),
+                "dropped": cnt.get("dropped", 0), "queued": cnt.get("queued", 0),
+                "depth": cnt.get("depth", 0), "rotations": n_rot,
+                "record_duration_ms": 1e3*self.period}
+        if len(acq)>0:
+            n = len(acq)
+            snap["wait_ms"] = 1e3*sum([a[2] for a in acq])/n
+            snap["get_ms"] = 1e3*sum([a[3] for a in acq])/n
+            snap["put_ms"] = 1e3*sum([a[4] for a in acq])/n
+            snap["get_max_ms"] = 1e3*max([a[3] for a in acq])
+        if len(wrt)>0:
+            n = len(wrt)
+            snap["write_ms"] = 1e3*sum([w[2] for w in wrt])/n
+            snap["write_max_ms"] = 1e3*max([w[2]+w[3] for w in wrt])
+            rot = [w[3] for w in wrt if w[3]>0]
+            snap["rotate_ms"] = 1e3*max(rot) if len(rot)>0 else 0.0
+
+        # the lower envelope of the lag (latency only adds to it) gives the
+        # offset and drift of the sample clock against the system clock
+        if len(clk)>0:
+            snap["clock_lag_ms"] = 1e3*min([c[1] for c in clk])
+        if len(clk)>3:
+            h = len(clk)//2
+            t_a = sum([c[0] for c in clk[:h]])/h
+            t_b = sum([c[0] for c in clk[h:]])/(len(clk)-h)
+            if t_b-t_a >= 0.25*self.window:
+                lag_a = min([c[1] for c in clk[:h]])
+                lag_b = min([c[1] for c in clk[h:]])
+                snap["drift_ppm"] = 1e6*(lag_b-lag_a)/(t_b-t_a)
+
+        # rolling throughput, over the records written in the window
+        if len(wrt)>1 and wrt[-1][0]>wrt[0][0]:
+            rate = (len(wrt)-1)/(wrt[-1][0]-wrt[0][0])
+            snap["records_per_s"] = rate
+            snap["samples_per_s"] = rate*self.record_length
+            snap["MB_per_s"] = rate*self.record_length*self.nchan*4/1e6
+
+        # load: fraction of the record duration spent by the busiest stage;
+        # headroom before overflow is what is left of it
+        busy = 0.0
+        if "get_ms" in snap:
+            busy = max(busy, snap["get_ms"]+snap["put_ms"])
+        if "write_ms" in snap:
+            busy = max(busy, snap["write_ms"])
+        if self.period>0:
+            snap["load"] = busy/(1e3*self.period)
+            snap["headroom"] = 1.0-snap["load"]
+
+        # time left before the write queue is full, if it is filling up
+        snap["time_to_full_s"] = None
+        if len(acq)>1 and acq[-1][0]>acq[0][0] and snap["depth"]>0:
+            growth = (acq[-1][5]-acq[0][5])/(acq[-1][0]-acq[0][0])
+            if growth>0:
+                snap["time_to_full_s"] = (snap["depth"]-snap["queued"])/growth
+        return snap
+
+    def publish(self):
+        snap = self.snapshot()
+        self.last = snap
+        if self.log is not None:
+            self.log.write(json.dumps(snap)+"\n")
+        if self.verbose:
+            print(self.status_line(snap))
+
+    def status_line(self, snap):
+        line = "Records: "+str(snap["records"])+" written: "+str(snap["written"])
+        line = line+" queued: "+str(snap["queued"])+"/"+str(snap["depth"])
+        if "MB_per_s" in snap:
+            line = line+" | "+str(round(snap["MB_per_s"],2))+" MB/s"
+        if "write_ms" in snap:
+            line = line+" | write "+str(round(snap["write_ms"],2))+" ms"
+        if "headroom" in snap:
+            line = line+" | headroom "+str(round(100*snap["headroom"]))+"%"
+        if "drift_ppm" in snap:
+            line = line+" | clock lag "+str(round(snap["clock_lag_ms"],1))+" ms, drift "+str(round(snap["drift_ppm"]))+" ppm"
+        if snap["time_to_full_s"] is not None:
+            line = line+" | queue full in "+str(round(snap["time_to_full_s"],1))+" s"
+        if snap["dropped"]>0:
+            line = line+" | dropped: "+str(snap["dropped"])
+        return line
+
+    def close(self):
+        self.publish()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
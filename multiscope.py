@@ -0,0 +1,264 @@
+import collections
+import threading
+import time
+import numpy as np
+from acquisition import RecordReader
+from dataready import DataReadyWaiter
+
+class DeviceStream():
+    # Acquisition thread of one device of a MultiScope. Records are read as
+    # soon as the device has them, into a ring of buffers of its own, and
+    # queued with their sample index. When the ring is full (another device
+    # is late) the record is still read, so that this device does not
+    # overflow, and counted as dropped.
+    def __init__(self, scp, lib, serial_number):
+        self.scp = scp
+        self.lib = lib
+        self.serial_number = serial_number
+        self.ch = []
+        self.lock = threading.Lock()
+        self.th = None
+        self.stop = False
+        self.overflow = False
+        self.ready = collections.deque()
+        self.free = collections.deque()
+        # counters over the whole run, restarts included
+        self.n_read = 0
+        self.n_dropped = 0
+        self.n_missing = 0
+        self.n_overflows = 0
+        self.max_queued = 0
+        self.wait_stats = {}
+
+    def start(self, depth, notify):
+        self.ch = [c for c, chan in enumerate(self.scp.channels) if chan.enabled]
+        n = self.scp.record_length
+        self.buffers = np.zeros((depth, len(self.ch), n), dtype=np.float32)
+        self.scratch = np.zeros((len(self.ch), n), dtype=np.float32)
+        self.free = collections.deque(range(depth))
+        self.ready = collections.deque()
+        self.index = 0
+        self.stop = False
+        self.overflow = False
+        self.notify = notify
+        self.scp.start()
+        self.th = threading.Thread(target=self.run)
+        self.th.start()
+
+    def run(self):
+        waiter = DataReadyWaiter(self.scp, self.scp.record_length/self.scp.sample_rate)
+        reader = RecordReader(self.scp, self.lib, self.ch)
+        while not self.stop:
+            if not waiter.wait(lambda: self.stop):
+                break
+            if self.scp.is_data_overflow:
+                with self.lock:
+                    self.overflow = True
+                    self.n_overflows = self.n_overflows+1
+                print("Data overflow on device #", self.serial_number)
+                self.notify()
+                break
+            with self.lock:
+                slot = self.free.popleft() if len(self.free)>0 else None
+            n = reader.read_into(self.scratch if slot is None else self.buffers[slot])
+            with self.lock:
+                self.n_read = self.n_read+1
+                if slot is None:
+                    self.n_dropped = self.n_dropped+1
+                else:
+                    self.ready.append((slot, self.index, n))
+                    self.max_queued = max(self.max_queued, len(self.ready))
+            self.index = self.index+n
+            self.notify()
+        reader.close()
+        self.wait_stats = waiter.stats()
+
+    def head(self):
+        # (slot, index, n) of the oldest queued record, or None
+        with self.lock:
+            if len(self.ready)==0:
+                return None
+            return self.ready[0]
+
+    def pop(self):
+        with self.lock:
+            slot, index, n = self.ready.popleft()
+        return slot
+
+    def release(self, slot):
+        with self.lock:
+            self.free.append(slot)
+
+    def halt(self):
+        self.stop = True
+        if self.th is not None:
+            self.th.join()
+            self.th = None
+        self.scp.stop()
+
+    def stats(self):
+        with self.lock:
+            return {"serial_number": self.serial_number,
+                    "records": self.n_read,
+                    "dropped": self.n_dropped,
+                    "missing": self.n_missing,
+                    "overflows": self.n_overflows,
+                    "queued": len(self.ready),
+                    "max_queued": self.max_queued}
+
+class MultiScope():
+    # Several independent oscilloscopes seen as one by the engine: channels
+    # are numbered across the devices in turn, settings are applied to all of
+    # them, and each device is drained by its own DeviceStream thread. A
+    # record is ready once every device has queued one; records are merged by
+    # sample index, the channels of a device that dropped the record being
+    # filled with NaN. The devices are started one after the other and their
+    # sample clocks are not synchronized: the start offsets are kept in
+    # start_offsets, and drift between the devices is not corrected.
+    def __init__(self, scps, lib, serial_numbers, depth=16):
+        self.scps = scps
+        self.devices = [DeviceStream(scp, lib, sn) for scp, sn in zip(scps, serial_numbers)]
+        self.depth = depth
+        self.channels = []
+        self.offsets = []
+        for scp in scps:
+            self.offsets.append(len(self.channels))
+            self.channels = self.channels+list(scp.channels)
+        self.resolutions = [r for r in scps[0].resolutions if all([r in scp.resolutions for scp in scps])]
+        self.measure_modes = scps[0].measure_modes
+        for scp in scps[1:]:
+            self.measure_modes = self.measure_modes & scp.measure_modes
+        self.active = []
+        self.rows = None
+        self.start_offsets = []
+        self.callback = None
+
+    # settings are written to all devices, then set to the value read back
+    # from the first one so that all devices agree
+    def set_all(self, name, value):
+        setattr(self.scps[0], name, value)
+        value = getattr(self.scps[0], name)
+        for scp in self.scps[1:]:
+            setattr(scp, name, value)
+
+    def _get_sample_rate(self):
+        return self.scps[0].sample_rate
+
+    def _set_sample_rate(self, value):
+        self.set_all("sample_rate", value)
+
+    sample_rate = property(_get_sample_rate, _set_sample_rate)
+
+    def _get_resolution(self):
+        return self.scps[0].resolution
+
+    def _set_resolution(self, value):
+        self.set_all("resolution", value)
+
+    resolution = property(_get_resolution, _set_resolution)
+
+    def _get_record_length(self):
+        return self.scps[0].record_length
+
+    def _set_record_length(self, value):
+        self.set_all("record_length", value)
+
+    record_length = property(_get_record_length, _set_record_length)
+
+    def _get_measure_mode(self):
+        return self.scps[0].measure_mode
+
+    def _set_measure_mode(self, value):
+        self.set_all("measure_mode", value)
+
+    measure_mode = property(_get_measure_mode, _set_measure_mode)
+
+    def set_callback_data_ready(self, func):
+        # the engine's DataReadyWaiter is woken up by the device threads
+        self.callback = func
+
+    def set_callback_data_overflow(self, func):
+        self.callback = func
+
+    def notify(self):
+        if self.callback is not None:
+            self.callback()
+
+    def start(self):
+        # devices without enabled channels are left out
+        self.active = []
+        for k, dev in enumerate(self.devices):
+            if any([chan.enabled for chan in dev.scp.channels]):
+                self.active.append(k)
+        self.rows = None
+        times = []
+        for k in self.active:
+            self.devices[k].start(self.depth, self.notify)
+            times.append(time.time())
+        self.start_offsets = [t-times[0] for t in times]
+
+    def stop(self):
+        for k in self.active:
+            self.devices[k].halt()
+
+    @property
+    def is_data_ready(self):
+        if len(self.active)==0:
+            return False
+        return all([self.devices[k].head() is not None for k in self.active])
+
+    @property
+    def is_data_overflow(self):
+        return any([self.devices[k].overflow for k in self.active])
+
+    def map_rows(self, ch):
+        # rows of the merged record and of the device buffers, per device
+        self.rows = []
+        for k in self.active:
+            dev = self.devices[k]
+            out_rows = []
+            dev_rows = []
+            for j, c in enumerate(dev.ch):
+                if self.offsets[k]+c in ch:
+                    out_rows.append(ch.index(self.offsets[k]+c))
+                    dev_rows.append(j)
+            self.rows.append((dev, out_rows, dev_rows))
+
+    def get_data_into(self, out, ch):
+        # merge the oldest record of each device into out (rows in the order
+        # of ch); returns the number of samples per channel
+        if self.rows is None:
+            self.map_rows(ch)
+        heads = [dev.head() for dev, out_rows, dev_rows in self.rows]
+        index = min([h[1] for h in heads])
+        n = min([h[2] for h in heads if h[1]==index])
+        n = min(n, out.shape[1])
+        for (dev, out_rows, dev_rows), (slot, first, m) in zip(self.rows, heads):
+            if first==index:
+                out[out_rows, :n] = dev.buffers[slot][dev_rows, :n]
+                dev.pop()
+                dev.release(slot)
+            else:
+                # dropped by this device
+                out[out_rows, :n] = np.nan
+                with dev.lock:
+                    dev.n_missing = dev.n_missing+1
+        return n
+
+    def stats(self):
+        res = []
+        for k, dev in enumerate(self.devices):
+            st = dev.stats()
+            if k in self.active:
+                st["start_offset"] = self.start_offsets[self.active.index(k)]
+            res.append(st)
+        return res
+
+    def print_stats(self):
+        for st in self.stats():
+            line = "Device #"+str(st["serial_number"])+": records "+str(st["records"])
+            line = line+" dropped: "+str(st["dropped"])+" missing: "+str(st["missing"])
+            line = line+" overflows: "+str(st["overflows"])+" max queued: "+str(st["max_queued"])
+            if "start_offset" in st:
+                line = line+" start offset: "+str(round(1e3*st["start_offset"],3))+" ms"
+            print(line)
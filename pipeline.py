@@ -0,0 +1,144 @@
+import threading
+import queue
+import time
+import numpy as np
+
+POLICY_LIST = ["block", "drop"]
+
+class ChunkPipeline():
+    # Bounded producer/consumer pipeline between the acquisition loop and the
+    # disk writer. Records are read (or copied) into a preallocated ring of
+    # buffers by the acquisition thread and persisted by a separate writer
+    # thread, so that slow writes do not delay the next get_data(). A slot
+    # can be held by other consumers (e.g. the watch) and goes back to the
+    # ring once all of them have released it.
+    def __init__(self, write_func, nchan, reclength, depth=8, policy="block", dtype=np.float32):
+        self.write_func = write_func
+        self.nchan = nchan
+        self.reclength = reclength
+        self.depth = max(1, int(depth))
+        self.policy = policy
+        self.buffers = np.zeros((self.depth, nchan, reclength), dtype=dtype)
+        self.lengths = [0]*self.depth
+        self.refs = [0]*self.depth
+        # records dropped when the ring is full still have to be read out
+        self.scratch = np.zeros((nchan, reclength), dtype=dtype)
+
+        self.free = queue.Queue()
+        for k in range(self.depth):
+            self.free.put(k)
+        self.ready = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.reset_counters()
+        self.error = None
+        self.writer_th = None
+
+    def reset_counters(self):
+        self.n_acquired = 0
+        self.n_written = 0
+        self.n_dropped = 0
+        self.max_queued = 0
+        self.write_time = 0.0
+        self.block_time = 0.0
+
+    def start(self):
+        self.writer_th = threading.Thread(target=self.run_writer)
+        self.writer_th.start()
+
+    def acquire(self):
+        # get a free slot from the ring; with the "drop" policy None is
+        # returned when all slots are in use, and the record is lost.
+        if self.policy=="drop":
+            try:
+                slot = self.free.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    self.n_dropped = self.n_dropped+1
+                return None
+        else:
+            t0 = time.perf_counter()
+            slot = self.free.get()
+            self.block_time = self.block_time + time.perf_counter()-t0
+        with self.lock:
+            self.refs[slot] = 1
+        return slot
+
+    def hold(self, slot):
+        with self.lock:
+            self.refs[slot] = self.refs[slot]+1
+
+    def release(self, slot):
+        with self.lock:
+            self.refs[slot] = self.refs[slot]-1
+            done = (self.refs[slot]==0)
+        if done:
+            self.free.put(slot)
+
+    def buffer(self, slot):
+        # where to read the next record: a ring slot, or the scratch buffer
+        if slot is None:
+            return self.scratch
+        return self.buffers[slot]
+
+    def record(self, slot):
+        return self.buffers[slot, :, :self.lengths[slot]]
+
+    def set_length(self, slot, n):
+        self.lengths[slot] = n
+
+    def submit(self, slot, count, stamp=None, index=None, clock=None):
+        # stamp: time of the first sample, index: first sample since the
+        # start of the stream, clock: system time when the record was read
+        if stamp is None:
+            stamp = time.time()
+        with self.lock:
+            self.n_acquired = self.n_acquired+1
+            self.max_queued = max(self.max_queued, self.ready.qsize()+1)
+        self.ready.put((slot, count, stamp, index, clock))
+
+    def run_writer(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                break
+            slot, count, stamp, index, clock = item
+            t0 = time.perf_counter()
+            try:
+                self.write_func(self.buffers[slot, :, :self.lengths[slot]], count, stamp, index, clock)
+            except Exception as e:
+                # keep draining so that acquisition never deadlocks on a full ring
+                if self.error is None:
+                    print("Write error:", e)
+                self.error = e
+            self.write_time = self.write_time + time.perf_counter()-t0
+            with self.lock:
+                self.n_written = self.n_written+1
+            self.release(slot)
+
+    def queued(self):
+        return self.ready.qsize()
+
+    def close(self):
+        # wait for all pending records to be written
+        if self.writer_th is not None:
+            self.ready.put(None)
+            self.writer_th.join()
+            self.writer_th = None
+
+    def counters(self):
+        with self.lock:
+            return {"acquired": self.n_acquired,
+                    "written": self.n_written,
+                    "dropped": self.n_dropped,
+                    "queued": self.ready.qsize(),
+                    "max_queued": self.max_queued,
+                    "depth": self.depth,
+                    "block_time": self.block_time,
+                    "write_time": self.write_time}
+
+    def print_counters(self):
+        cnt = self.counters()
+        print("Records acquired:", cnt["acquired"], " written:", cnt["written"], " dropped:", cnt["dropped"])
+        print("Max queue depth:", cnt["max_queued"], "/", cnt["depth"])
+        print("Time blocked (s):", round(cnt["block_time"],3), " writing (s):", round(cnt["write_time"],3))
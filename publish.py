@@ -0,0 +1,241 @@
+import argparse
+import queue
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from formats import to_counts, from_counts
+
+# Live publication of the records over TCP (localhost by default), for other
+# processes to follow the stream while it is being recorded. Each record is
+# sent as one frame:
+#   header   "<4sBBHIQQdd": magic b"TPSR", version, dtype code (b'f' float32
+#            volts, b'h' int16 or b'b' int8 codes), number of channels,
+#            number of samples, record number, stream index of the first
+#            sample, time of the first sample (POSIX), sampling frequency
+#   channels nchan x uint16: channel numbers (from 1)
+#   scale    nchan x 2 float64: gain and offset (volts = value*gain + offset)
+#   samples  nchan x n values, channel after channel
+# Slow subscribers never slow down the recorder: frames that do not fit in
+# their queue are dropped (and counted) for them only.
+
+MAGIC = b"TPSR"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHIQQdd")
+
+def pack_frame(data, chans, gains, offsets, count, index, stamp, sample_rate):
+    data = np.ascontiguousarray(data)
+    nchan, n = data.shape
+    head = HEADER.pack(MAGIC, VERSION, ord(data.dtype.char), nchan, n, count, index, stamp, sample_rate)
+    scale = np.empty((nchan, 2), dtype='<f8')
+    scale[:, 0] = gains
+    scale[:, 1] = offsets
+    return b"".join([head, np.asarray(chans, dtype='<u2').tobytes(), scale.tobytes(), data.tobytes()])
+
+def recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos<n:
+        k = sock.recv_into(view[pos:], n-pos)
+        if k==0:
+            return None
+        pos = pos+k
+    return buf
+
+class Subscriber():
+    # Client side: recv() returns the next record as a dict, with the samples
+    # in "data" (channel x sample) and "volts" converting them, or None once
+    # the recorder has stopped.
+    def __init__(self, host="127.0.0.1", port=5555, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+
+    def recv(self):
+        head = recv_exact(self.sock, HEADER.size)
+        if head is None:
+            return None
+        magic, version, code, nchan, n, count, index, stamp, fs = HEADER.unpack(bytes(head))
+        if magic!=MAGIC:
+            raise ValueError("Not a stream frame")
+        dtype = np.dtype(chr(code)).newbyteorder('<')
+        body = recv_exact(self.sock, nchan*2+nchan*16+nchan*n*dtype.itemsize)
+        if body is None:
+            return None
+        chans = np.frombuffer(body, dtype='<u2', count=nchan)
+        scale = np.frombuffer(body, dtype='<f8', count=2*nchan, offset=2*nchan).reshape(nchan, 2)
+        data = np.frombuffer(body, dtype=dtype, offset=18*nchan).reshape(nchan, n)
+        return {"record": count, "index": index, "time": stamp, "sample_rate": fs,
+                "chans": chans, "gains": scale[:, 0], "offsets": scale[:, 1], "data": data}
+
+    def volts(self, frame):
+        if frame["data"].dtype.kind=='i':
+            return from_counts(frame["data"], frame["gains"][:, None], frame["offsets"][:, None])
+        return frame["data"]*frame["gains"][:, None]+frame["offsets"][:, None]
+
+    def close(self):
+        self.sock.close()
+
+class Client():
+    # one connected subscriber, with its own queue and sending thread
+    def __init__(self, conn, addr, depth):
+        self.conn = conn
+        self.addr = addr
+        self.frames = queue.Queue(depth)
+        self.sent = 0
+        self.dropped = 0
+        self.alive = True
+        self.th = threading.Thread(target=self.run, daemon=True)
+        self.th.start()
+
+    def put(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped = self.dropped+1
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                self.conn.sendall(frame)
+                self.sent = self.sent+1
+            except OSError:
+                break
+        self.alive = False
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            # unblock the sender by closing the connection
+            self.conn.close()
+
+class Publisher():
+    # Records handed over by the acquisition loop (held in the ring of
+    # buffers) are packed in a worker thread and queued to every subscriber.
+    def __init__(self, host="127.0.0.1", port=5555, depth=8):
+        self.depth = depth
+        self.clients = []
+        self.lock = threading.Lock()
+        self.records = queue.Queue(2)
+        self.n_published = 0
+        self.n_skipped = 0
+        self.counts = False
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.accept_th = threading.Thread(target=self.accept, daemon=True)
+        self.accept_th.start()
+        self.th = None
+
+    def configure(self, okchans, sample_rate, gains=None, offsets=None, dtype=None):
+        # with gains, samples are sent as integer codes of the given dtype
+        self.chans = [c+1 for c in okchans]
+        self.sample_rate = sample_rate
+        self.counts = (gains is not None)
+        if self.counts:
+            self.gains = list(gains)
+            self.offsets = list(offsets)
+            self.dtype = dtype
+        else:
+            self.gains = [1.0]*len(okchans)
+            self.offsets = [0.0]*len(okchans)
+
+    def start(self):
+        self.th = threading.Thread(target=self.run)
+        self.th.start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print("Subscriber connected:", addr)
+            with self.lock:
+                self.clients.append(Client(conn, addr, self.depth))
+
+    def submit(self, data, release, count, stamp, index):
+        # never blocks: the record is skipped if the worker is behind
+        if len(self.clients)==0:
+            release()
+            return
+        try:
+            self.records.put_nowait((data, release, count, stamp, index))
+        except queue.Full:
+            self.n_skipped = self.n_skipped+1
+            release()
+
+    def run(self):
+        while True:
+            item = self.records.get()
+            if item is None:
+                break
+            data, release, count, stamp, index = item
+            try:
+                if self.counts:
+                    data = to_counts(data, self.gains, self.offsets, self.dtype)
+                frame = pack_frame(data, self.chans, self.gains, self.offsets, count, index, stamp, self.sample_rate)
+            finally:
+                release()
+            with self.lock:
+                self.clients = [cl for cl in self.clients if cl.alive]
+                clients = list(self.clients)
+            for cl in clients:
+                cl.put(frame)
+            self.n_published = self.n_published+1
+
+    def stats(self):
+        with self.lock:
+            clients = list(self.clients)
+        return {"subscribers": len([cl for cl in clients if cl.alive]),
+                "published": self.n_published, "skipped": self.n_skipped,
+                "dropped": sum([cl.dropped for cl in clients])}
+
+    def close(self):
+        if self.th is not None:
+            self.records.put(None)
+            self.th.join()
+            self.th = None
+        self.server.close()
+        with self.lock:
+            for cl in self.clients:
+                cl.close()
+            self.clients = []
+
+def main(args=None):
+    # simple local consumer: prints the rate and latency of the received records
+    parser = argparse.ArgumentParser(description="Follow a stream published by the recorder.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    opts = parser.parse_args(args)
+    sub = Subscriber(opts.host, opts.port)
+    t0 = time.time()
+    n = 0
+    nbytes = 0
+    while True:
+        frame = sub.recv()
+        if frame is None:
+            break
+        n = n+1
+        nbytes = nbytes+frame["data"].nbytes
+        now = time.time()
+        if now-t0>=1.0:
+            lag = now-frame["time"]-frame["data"].shape[1]/frame["sample_rate"]
+            print("Records:", n, " MB/s:", round(nbytes/1e6/(now-t0),2), " channels:", list(frame["chans"]),
+                  " sample:", frame["index"], " lag (ms):", round(1e3*lag,1))
+            t0 = now
+            n = 0
+            nbytes = 0
+    sub.close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,465 @@
+import collections
+import os
+import json
+import re
+import zlib
+import h5py
+import numpy as np
+from formats import INDEX_DTYPE, from_counts
+
+class Volts():
+    # Lazy conversion of stored integer codes into volts: nothing is read or
+    # converted until the object is sliced. Missing samples read as NaN.
+    def __init__(self, codes, gain, offset=0.0):
+        self.codes = codes
+        self.gain = gain
+        self.offset = offset
+        self.shape = codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        return from_counts(self.codes[key], self.gain, self.offset)
+
+    def __array__(self, dtype=None, copy=None):
+        v = self[...]
+        if dtype is not None:
+            v = v.astype(dtype)
+        return v
+
+def volts(dset, gain=None, offset=None):
+    # lazy volts of a stored channel; for a h5py dataset of codes the scale is
+    # read from the dataset attributes when not given
+    if gain is None:
+        if not "Gain" in dset.attrs:
+            return dset
+        gain = dset.attrs["Gain"]
+        offset = dset.attrs["Offset"]
+    if offset is None:
+        offset = 0.0
+    return Volts(dset, gain, offset)
+
+class BlockArray():
+    # (n_samples, n_channels) view of a ".binz" file, compressed by blocks of
+    # samples and per channel (delta + zlib); only the blocks covering a
+    # requested slice are read and decompressed
+    def __init__(self, fname, info):
+        self.fname = fname
+        self.dtype = np.dtype(info["Dtype"])
+        self.udtype = np.dtype('u'+str(self.dtype.itemsize))
+        self.blocks = info["Blocks"]
+        self.nchan = info["N_channels"]
+        self.shape = (info["N_samples"], self.nchan)
+        self.offsets = []
+        pos = 0
+        for block in self.blocks:
+            self.offsets.append(pos)
+            pos = pos+sum(block["Sizes"])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_block(self, b, k):
+        block = self.blocks[b]
+        pos = self.offsets[b]+sum(block["Sizes"][:k])
+        with open(self.fname, 'rb') as f:
+            f.seek(pos)
+            buf = f.read(block["Sizes"][k])
+        d = np.frombuffer(zlib.decompress(buf), dtype=self.udtype)
+        return np.cumsum(d, dtype=self.udtype).view(self.dtype)
+
+    def read(self, i0, i1, k):
+        out = np.empty(max(0, i1-i0), dtype=self.dtype)
+        for b, block in enumerate(self.blocks):
+            if block["Stop"]<=i0 or block["Start"]>=i1:
+                continue
+            x = self.read_block(b, k)
+            j0 = max(i0, block["Start"])
+            j1 = min(i1, block["Stop"])
+            out[j0-i0:j1-i0] = x[j0-block["Start"]:j1-block["Start"]]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        if isinstance(rows, int):
+            rows = slice(rows, rows+1 if rows!=-1 else None)
+            squeeze = True
+        else:
+            squeeze = False
+        i0, i1, step = rows.indices(self.shape[0])
+        chans = range(self.nchan)[cols]
+        if isinstance(chans, int):
+            out = self.read(i0, i1, chans)[::step]
+        else:
+            out = np.stack([self.read(i0, i1, k)[::step] for k in chans], axis=1)
+        if squeeze:
+            out = out[0]
+        return out
+
+class ChannelView():
+    # lazy single-channel view of a BlockArray
+    def __init__(self, data, k):
+        self.data = data
+        self.k = k
+        self.shape = (data.shape[0],)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.data[key, self.k]
+
+class RawRecording():
+    # Read-only view of a raw binary stream written with the ".bin" file
+    # format. The samples are exposed as a numpy.memmap, so that opening a
+    # file does not read any data and slicing only loads what is used.
+    def __init__(self, fname):
+        base = os.path.splitext(fname)[0]
+        self.fname = base+".bin"
+        with open(base+".json", 'r') as h:
+            self.info = json.load(h)
+        self.dtype = np.dtype(self.info["Dtype"])
+        self.nchan = self.info["N_channels"]
+        self.sample_rate = self.info["Sampling_freq"]
+        self.chan_names = [chan["Name"] for chan in self.info["Channels"]]
+
+        # per-record index (see formats.RecordIndex), if any
+        self.index = None
+        if os.path.exists(base+".idx"):
+            self.index = np.fromfile(base+".idx", dtype=INDEX_DTYPE)
+
+        # files recompressed after recording (see compress.py)
+        if self.info.get("Compression")=="delta-zlib":
+            self.fname = base+".binz"
+            self.data = BlockArray(self.fname, self.info)
+            self.n_samples = self.data.shape[0]
+            return
+
+        # the header may lag behind the data if the file was not closed
+        n_file = os.path.getsize(self.fname)//(self.nchan*self.dtype.itemsize)
+        n = self.info.get("N_samples", n_file)
+        if n==0 or n>n_file:
+            n = n_file
+        self.n_samples = n
+        if n>0:
+            self.data = np.memmap(self.fname, dtype=self.dtype, mode='r', shape=(n, self.nchan))
+        else:
+            self.data = np.zeros((0, self.nchan), dtype=self.dtype)
+
+    def __len__(self):
+        return self.n_samples
+
+    def chan_index(self, chan):
+        if isinstance(chan, str):
+            return self.chan_names.index(chan)
+        return chan
+
+    def counts(self, chan):
+        # zero-copy (strided) view of the stored samples of one channel,
+        # given by name or position
+        if isinstance(self.data, BlockArray):
+            return ChannelView(self.data, self.chan_index(chan))
+        return self.data[:, self.chan_index(chan)]
+
+    def channel(self, chan):
+        # samples of one channel in volts; integer codes are converted lazily
+        k = self.chan_index(chan)
+        info = self.info["Channels"][k]
+        if "Gain" in info:
+            return Volts(self.counts(k), info["Gain"], info.get("Offset", 0.0))
+        return self.counts(k)
+
+    def time(self, start=0, stop=None, absolute=False):
+        # time of the samples from the start of the file, or POSIX time
+        if stop is None:
+            stop = self.n_samples
+        t = np.arange(start, stop)/self.sample_rate
+        if absolute:
+            if not "Start_time" in self.info:
+                raise ValueError("the start time of the file is unknown (written without Start_time): use relative times")
+            t = t+self.info["Start_time"]
+        return t
+
+    def window(self, chan, t0, t1):
+        i0 = max(0, int(np.floor(t0*self.sample_rate)))
+        i1 = min(self.n_samples, int(np.ceil(t1*self.sample_rate)))
+        return self.channel(chan)[i0:i1]
+
+def open_raw(fname):
+    return RawRecording(fname)
+
+class StreamReader():
+    # Random access to a whole recording, i.e. the rotated files of one base
+    # name in a folder (HDF5 of both layouts, .bin and .binz). The records of
+    # all files are indexed once by their position in the stream (first
+    # sample index, length, time), and the index is cached in
+    # <name>_index.npz; only new or modified files are indexed again. Samples
+    # are read by blocks, kept in a LRU cache, so that reading a time window
+    # only touches the records it overlaps.
+    BLOCK = 1<<16
+
+    def __init__(self, folder, name="datastream", cache_mb=256, max_open=8):
+        self.folder = folder
+        self.name = name
+        self.cache_bytes = cache_mb*1e6
+        self.max_open = max_open
+        self.cache = collections.OrderedDict()
+        self.cached = 0
+        self.handles = collections.OrderedDict()
+        self.index_name = os.path.join(folder, name+"_index.npz")
+        self.files = []
+        self.refresh()
+
+    def list_files(self):
+        pattern = re.compile(re.escape(self.name)+r"(\d{6})?\.(hdf5|bin|binz)$")
+        names = [fn for fn in os.listdir(self.folder) if pattern.match(fn)]
+        return sorted(names)
+
+    def refresh(self):
+        # (re)build the index of the files that changed since it was cached
+        old = {}
+        if os.path.exists(self.index_name):
+            cache = np.load(self.index_name)
+            meta = json.loads(str(cache["meta"]))
+            for k, fmeta in enumerate(meta):
+                sel = (cache["fileno"]==k)
+                old[fmeta["name"]] = (fmeta, {key: cache[key][sel] for key in ["record", "sample", "start", "length", "time"]})
+
+        self.files = []
+        tables = []
+        changed = False
+        prev_end = 0
+        for fn in self.list_files():
+            st = os.stat(os.path.join(self.folder, fn))
+            if fn in old and old[fn][0]["size"]==st.st_size and old[fn][0]["mtime"]==st.st_mtime:
+                fmeta, table = old[fn]
+            else:
+                fmeta, table = self.index_file(fn, prev_end)
+                fmeta["size"] = st.st_size
+                fmeta["mtime"] = st.st_mtime
+                changed = True
+            if len(table["sample"])==0:
+                # files without samples are left out
+                continue
+            self.files.append(fmeta)
+            tables.append(table)
+            prev_end = int(table["sample"][-1]+table["length"][-1])
+        if len(old)!=len(self.files):
+            changed = True
+
+        # records of all files, in stream order
+        keys = ["record", "sample", "start", "length", "time"]
+        if len(tables)>0:
+            self.records = {key: np.concatenate([t[key] for t in tables]) for key in keys}
+            self.records["fileno"] = np.concatenate([np.full(len(t["sample"]), k, dtype='int64') for k, t in enumerate(tables)])
+        else:
+            self.records = {key: np.zeros(0) for key in keys+["fileno"]}
+        order = np.argsort(self.records["sample"], kind='stable')
+        for key in self.records:
+            self.records[key] = self.records[key][order]
+        self.ends = self.records["sample"]+self.records["length"]
+
+        if changed:
+            np.savez(self.index_name, meta=np.array(json.dumps(self.files)), **self.records)
+
+        if len(self.files)>0:
+            self.sample_rate = self.files[0]["fs"]
+            self.chan_names = list(self.files[0]["chans"].keys())
+            # POSIX time of the first sample (None for older files)
+            self.start_time = self.files[0]["start_time"]
+        else:
+            self.sample_rate = 1.0
+            self.chan_names = []
+            self.start_time = None
+        self.n_samples = int(self.ends.max()) if len(self.ends)>0 else 0
+
+    def index_file(self, fn, first):
+        # description of one file and table of its records; files without
+        # index (older versions) are described from their layout
+        path = os.path.join(self.folder, fn)
+        fmeta = {"name": fn, "chans": {}, "gains": {}}
+        if fn.endswith(".hdf5"):
+            with h5py.File(path, 'r') as f:
+                info = f["Info"].attrs
+                fmeta["format"] = "hdf5"
+                fmeta["layout"] = str(info.get("Layout", "chunks"))
+                fmeta["fs"] = float(info["Sampling_freq"])
+                fmeta["start_time"] = float(info["Start_time"]) if "Start_time" in info else None
+                first = int(info.get("First_sample", first))
+                for key in sorted(info.keys()):
+                    if re.match(r"chan\d\d$", key):
+                        fmeta["chans"][str(info[key])] = key
+                        if key+"_gain" in info:
+                            fmeta["gains"][key] = [float(info[key+"_gain"]), float(info[key+"_offset"])]
+                index = f["Index"] if "Index" in f else None
+                if index is not None and "sample" in index:
+                    table = {key: index[key][:] for key in ["record", "sample", "start", "length", "time"]}
+                elif fmeta["layout"]=="append" and index is not None:
+                    table = {key: index[key][:] for key in ["record", "start", "length", "time"]}
+                    table["sample"] = first+table["start"]
+                else:
+                    groups = sorted([g for g in f.keys() if g.startswith("chunk_")])
+                    if len(groups)==0 or len(fmeta["chans"])==0:
+                        # stopped before the first record
+                        groups = []
+                        length = np.zeros(0, dtype='int64')
+                    else:
+                        key = list(fmeta["chans"].values())[0]
+                        length = np.array([f[g][key].shape[0] for g in groups], dtype='int64')
+                    start = (np.cumsum(length)-length).astype('int64')
+                    table = {"record": np.array([int(g[6:]) for g in groups], dtype='int64'),
+                             "sample": first+start, "start": start, "length": length,
+                             "time": np.full(len(groups), np.nan)}
+        else:
+            rec = RawRecording(path)
+            fmeta["format"] = "raw"
+            fmeta["fs"] = float(rec.sample_rate)
+            fmeta["start_time"] = rec.info.get("Start_time")
+            first = int(rec.info.get("First_sample", first))
+            for k, chan in enumerate(rec.info["Channels"]):
+                fmeta["chans"][chan["Name"]] = k
+                if "Gain" in chan:
+                    fmeta["gains"][str(k)] = [chan["Gain"], chan.get("Offset", 0.0)]
+            if rec.index is not None:
+                table = {key: rec.index[key] for key in ["record", "sample", "start", "length", "time"]}
+            elif rec.n_samples==0:
+                table = {key: np.zeros(0) for key in ["record", "sample", "start", "length", "time"]}
+            else:
+                table = {"record": np.zeros(1, dtype='int64'), "sample": np.array([first]),
+                         "start": np.zeros(1, dtype='int64'), "length": np.array([rec.n_samples]),
+                         "time": np.full(1, np.nan)}
+        for key in ["record", "sample", "start", "length"]:
+            table[key] = np.asarray(table[key], dtype='int64')
+        table["time"] = np.asarray(table["time"], dtype='float64')
+        return fmeta, table
+
+    def handle(self, k):
+        # open files, the least recently used being closed first
+        if k in self.handles:
+            self.handles.move_to_end(k)
+            return self.handles[k]
+        path = os.path.join(self.folder, self.files[k]["name"])
+        if self.files[k]["format"]=="hdf5":
+            h = h5py.File(path, 'r')
+        else:
+            h = RawRecording(path)
+        self.handles[k] = h
+        while len(self.handles)>self.max_open:
+            k_old, h_old = self.handles.popitem(last=False)
+            if isinstance(h_old, h5py.File):
+                h_old.close()
+        return h
+
+    def block(self, row, b, chan):
+        # samples [b*BLOCK, (b+1)*BLOCK) of a record, in volts
+        key = (row, b, chan)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        k = int(self.records["fileno"][row])
+        fmeta = self.files[k]
+        ckey = fmeta["chans"][chan]
+        start = int(self.records["start"][row])
+        a = b*self.BLOCK
+        z = min(int(self.records["length"][row]), a+self.BLOCK)
+        h = self.handle(k)
+        if fmeta["format"]=="raw":
+            x = np.asarray(h.counts(ckey)[start+a:start+z])
+        elif fmeta["layout"]=="append":
+            x = h[ckey][start+a:start+z]
+        else:
+            x = h["chunk_"+str(int(self.records["record"][row])).rjust(8,'0')][ckey][a:z]
+        gain = fmeta["gains"].get(str(ckey))
+        if gain is not None:
+            x = from_counts(x, gain[0], gain[1])
+        else:
+            x = x.astype(np.float32, copy=False)
+        self.cache[key] = x
+        self.cached = self.cached+x.nbytes
+        while self.cached>self.cache_bytes and len(self.cache)>1:
+            old_key, old = self.cache.popitem(last=False)
+            self.cached = self.cached-old.nbytes
+        return x
+
+    def chan_name(self, chan):
+        if isinstance(chan, int):
+            return self.chan_names[chan]
+        return chan
+
+    def read_samples(self, chan, i0, i1):
+        # samples i0 to i1 (from the start of the stream) of one channel, in
+        # volts; samples missing from the recording (dropped records) are NaN
+        chan = self.chan_name(chan)
+        i0 = max(0, int(i0))
+        i1 = max(i0, int(i1))
+        out = np.full(i1-i0, np.nan, dtype=np.float32)
+        lo = np.searchsorted(self.ends, i0, side='right')
+        hi = np.searchsorted(self.records["sample"], i1, side='left')
+        for row in range(lo, hi):
+            s = int(self.records["sample"][row])
+            a = max(i0, s)-s
+            z = min(i1, int(self.ends[row]))-s
+            for b in range(a//self.BLOCK, (z-1)//self.BLOCK+1):
+                x = self.block(row, b, chan)
+                j0 = max(a, b*self.BLOCK)
+                j1 = min(z, b*self.BLOCK+len(x))
+                out[s+j0-i0:s+j1-i0] = x[j0-b*self.BLOCK:j1-b*self.BLOCK]
+        return out
+
+    def check_start_time(self):
+        if self.start_time is None:
+            raise ValueError("the start time of the stream is unknown (files written without Start_time): use relative times")
+
+    def read(self, chan, t0, t1, absolute=False):
+        # samples between t0 and t1, in seconds from the start of the stream,
+        # or in POSIX time with absolute=True
+        if absolute:
+            self.check_start_time()
+            t0 = t0-self.start_time
+            t1 = t1-self.start_time
+        i0 = int(np.floor(t0*self.sample_rate))
+        i1 = int(np.ceil(t1*self.sample_rate))
+        return self.read_samples(chan, i0, i1)
+
+    def time(self, i0, i1, absolute=False):
+        t = np.arange(i0, i1)/self.sample_rate
+        if absolute:
+            self.check_start_time()
+            t = t+self.start_time
+        return t
+
+    def close(self):
+        for h in self.handles.values():
+            if isinstance(h, h5py.File):
+                h.close()
+        self.handles.clear()
+        self.cache.clear()
+        self.cached = 0
+
+def open_stream(folder, name="datastream", cache_mb=256):
+    return StreamReader(folder, name, cache_mb)
+
+def read_summary(folder, name="datastream", records=False):
+    # the summaries of all the files of a stream, concatenated: per-bin
+    # statistics and PSD (and per-record statistics with records=True),
+    # as dicts of arrays under "bins" and "records", with "freq" and "info"
+    pattern = re.compile(re.escape(name)+r"(\d{6})?_summary\.hdf5$")
+    names = sorted([fn for fn in os.listdir(folder) if pattern.match(fn)])
+    groups = ["Bins", "Records"] if records else ["Bins"]
+    parts = {grp: collections.defaultdict(list) for grp in groups}
+    res = {"freq": None, "info": {}}
+    for fn in names:
+        with h5py.File(os.path.join(folder, fn), 'r') as f:
+            if len(res["info"])==0:
+                res["info"] = dict(f.attrs)
+                if "freq" in f:
+                    res["freq"] = f["freq"][()]
+            for grp in groups:
+                for key in f[grp]:
+                    parts[grp][key].append(f[grp][key][()])
+    for grp in groups:
+        res[grp.lower()] = {key: np.concatenate(vals) for key, vals in parts[grp].items()}
+    return res
@@ -0,0 +1,203 @@
+import time
+import threading
+import numpy as np
+
+# Synthetic stand-in for the libtiepie module, used to test and benchmark the
+# streaming code without an instrument. It provides the subset of libtiepie
+# used by the engine: the device list, device and oscilloscope objects, and
+# the constants below. Use configure() to change the simulated setup.
+
+DEVICETYPE_OSCILLOSCOPE = 1
+MM_BLOCK = 1
+MM_STREAM = 2
+CK_DCV = 1
+CK_ACV = 2
+
+PID_COMBI = 2
+PID_HS5 = 15
+
+class SimChannel():
+    def __init__(self):
+        self.enabled = True
+        self.ranges = [0.2, 0.4, 0.8, 2.0, 4.0, 8.0, 20.0, 40.0, 80.0]
+        self.range = 8.0
+        self.coupling = CK_DCV
+
+class SimOscilloscope():
+    # Records are produced in real time at sample_rate; a record not read
+    # within buffer_records records time raises the overflow flag, as the
+    # device memory would. Stalls (get_data blocking for a while) and
+    # overflows can also be injected at given record numbers.
+    def __init__(self, n_chan, settings):
+        self.settings = settings
+        self.channels = [SimChannel() for c in range(n_chan)]
+        self.resolutions = list(settings["resolutions"])
+        self._resolution = self.resolutions[0]
+        self._sample_rate = 1e6
+        self._record_length = 5000
+        self.measure_modes = MM_BLOCK | MM_STREAM
+        self.measure_mode = MM_BLOCK
+        self.t0 = None
+        self.n_read = 0
+        self.overflow = False
+        self.pool = None
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng(settings["seed"])
+
+    def _get_sample_rate(self):
+        return self._sample_rate
+
+    def _set_sample_rate(self, value):
+        self._sample_rate = float(min(max(value, 1.0), self.settings["max_sample_rate"]))
+
+    sample_rate = property(_get_sample_rate, _set_sample_rate)
+
+    def _get_resolution(self):
+        return self._resolution
+
+    def _set_resolution(self, value):
+        if value in self.resolutions:
+            self._resolution = value
+
+    resolution = property(_get_resolution, _set_resolution)
+
+    def _get_record_length(self):
+        return self._record_length
+
+    def _set_record_length(self, value):
+        self._record_length = int(min(max(value, 1), self.settings["max_record_length"]))
+
+    record_length = property(_get_record_length, _set_record_length)
+
+    def make_pool(self):
+        # a few records of sine + noise, quantized to the resolution, served
+        # in turn so that get_data costs no more than a copy
+        n = self._record_length
+        npool = self.settings["pool_records"]
+        t = np.arange(n*npool)/self._sample_rate
+        self.pool = []
+        for c, chan in enumerate(self.channels):
+            lsb = 2*chan.range/2**self._resolution
+            x = 0.5*chan.range*np.sin(2*np.pi*self.settings["signal_freq"]*(c+1)*t)
+            x = x+self.settings["noise"]*chan.range*self.rng.standard_normal(len(t))
+            x = np.clip(np.round(x/lsb), -2**(self._resolution-1), 2**(self._resolution-1)-1)*lsb
+            self.pool.append(x.astype(np.float32).reshape(npool, n))
+
+    def start(self):
+        self.make_pool()
+        self.n_read = 0
+        self.overflow = False
+        self.t0 = time.perf_counter()
+
+    def stop(self):
+        self.t0 = None
+
+    def produced(self):
+        # number of records acquired by the device since start
+        if self.t0 is None:
+            return 0
+        return int((time.perf_counter()-self.t0)*self._sample_rate/self._record_length)
+
+    @property
+    def is_data_ready(self):
+        return (not self.is_data_overflow) and self.produced()>self.n_read
+
+    @property
+    def is_data_overflow(self):
+        if not self.overflow and self.t0 is not None:
+            if self.n_read in self.settings["overflow_at"]:
+                self.overflow = True
+            elif self.produced()-self.n_read > self.settings["buffer_records"]:
+                self.overflow = True
+        return self.overflow
+
+    def next_record(self):
+        with self.lock:
+            k = self.n_read
+            self.n_read = self.n_read+1
+        if k in self.settings["stall_at"]:
+            time.sleep(self.settings["stall_at"][k])
+        elif self.settings["stall_prob"]>0 and self.rng.random()<self.settings["stall_prob"]:
+            time.sleep(self.settings["stall_time"])
+        if self.pool is None:
+            self.make_pool()
+        return k
+
+    def get_data(self):
+        k = self.next_record()
+        npool = len(self.pool[0])
+        data = []
+        for c, chan in enumerate(self.channels):
+            if chan.enabled:
+                data.append(self.pool[c][k%npool].copy())
+            else:
+                data.append(None)
+        return data
+
+    def get_data_into(self, out, ch):
+        # fill out[k] with the samples of channel ch[k], without allocating
+        k = self.next_record()
+        npool = len(self.pool[0])
+        n = min(out.shape[1], self._record_length)
+        for j, c in enumerate(ch):
+            out[j, :n] = self.pool[c][k%npool, :n]
+        return n
+
+class SimDevice():
+    def __init__(self, serial_number, product_id, contained=None, n_chan=4):
+        self.name = "Simulated HS5" if product_id!=PID_COMBI else "Simulated combined instrument"
+        self.serial_number = serial_number
+        self.product_id = product_id
+        self.contained_serial_numbers = contained if contained is not None else []
+        self.n_chan = n_chan
+        self.settings = None
+
+    def _get_product_id(self):
+        return self.product_id
+
+    def can_open(self, device_type):
+        return device_type==DEVICETYPE_OSCILLOSCOPE
+
+    def open_oscilloscope(self):
+        return SimOscilloscope(self.n_chan, self.settings)
+
+class SimDeviceList(list):
+    def __init__(self):
+        list.__init__(self)
+        self.settings = {}
+        configure_list(self)
+
+    def update(self):
+        del self[:]
+        n_instr = self.settings["n_instr"]
+        n_chan = self.settings["n_chan"]
+        serials = [self.settings["first_serial"]+i for i in range(n_instr)]
+        if n_instr>1 and self.settings["combined"]:
+            devices = [SimDevice(serials[0]+1000, PID_COMBI, serials, n_chan*n_instr)]
+        else:
+            devices = [SimDevice(sn, PID_HS5, None, n_chan) for sn in serials]
+        for device in devices:
+            device.settings = self.settings
+            self.append(device)
+
+def configure_list(devlist, n_instr=1, n_chan=4, combined=True, max_sample_rate=200e6,
+                   max_record_length=1<<24, resolutions=(8, 12, 14, 16), buffer_records=8,
+                   signal_freq=50.0, noise=0.01, pool_records=4, stall_at=None, stall_prob=0.0,
+                   stall_time=0.1, overflow_at=None, first_serial=29000, seed=0):
+    devlist.settings.update({"n_instr": n_instr, "n_chan": n_chan, "combined": combined,
+                             "max_sample_rate": max_sample_rate, "max_record_length": max_record_length,
+                             "resolutions": resolutions, "buffer_records": buffer_records,
+                             "signal_freq": signal_freq, "noise": noise, "pool_records": pool_records,
+                             "stall_at": dict(stall_at or {}), "stall_prob": stall_prob,
+                             "stall_time": stall_time, "overflow_at": set(overflow_at or []),
+                             "first_serial": first_serial, "seed": seed})
+
+device_list = SimDeviceList()
+
+def configure(**kwargs):
+    # n_instr instruments of n_chan channels (at most 4 x 4 in the GUI),
+    # merged into one combined instrument if combined is True; stall_at maps
+    # record numbers to a delay of get_data (s), overflow_at lists record
+    # numbers at which an overflow is raised
+    configure_list(device_list, **kwargs)
+    device_list.update()
@@ -0,0 +1,251 @@
+import os
+import queue
+import threading
+import h5py
+import numpy as np
+
+# Statistics of the stream computed while recording: moments, extrema and
+# RMS of each channel per record and per time bin, and a Welch estimate of
+# the power spectral density per bin. The summary of each output file is
+# written next to it, in <file base>_summary.hdf5.
+
+SUMMARY_FIELDS = ["mean", "std", "min", "max", "rms"]
+
+def block_stats(x):
+    # count, mean, sum of squared deviations, min and max of each row of x;
+    # rows of NaN (channels missing from the record) count for nothing
+    x = np.asarray(x, dtype=np.float64)
+    m = x.shape[1]
+    ok = ~np.isnan(x[:, 0])
+    mean = np.where(ok, x.mean(axis=1), 0.0)
+    m2 = np.where(ok, ((x-mean[:, None])**2).sum(axis=1), 0.0)
+    lo = np.where(ok, x.min(axis=1), np.inf)
+    hi = np.where(ok, x.max(axis=1), -np.inf)
+    return np.where(ok, float(m), 0.0), mean, m2, lo, hi
+
+class Moments():
+    # running moments of each channel, merged block by block with the
+    # pairwise form of Welford's update
+    def __init__(self, nchan):
+        self.n = np.zeros(nchan)
+        self.mean = np.zeros(nchan)
+        self.m2 = np.zeros(nchan)
+        self.min = np.full(nchan, np.inf)
+        self.max = np.full(nchan, -np.inf)
+
+    def merge(self, stats):
+        nb, mean, m2, lo, hi = stats
+        n = self.n+nb
+        frac = np.divide(nb, n, out=np.zeros(len(n)), where=n>0)
+        delta = mean-self.mean
+        self.m2 = self.m2+m2+delta**2*self.n*frac
+        self.mean = self.mean+delta*frac
+        self.n = n
+        self.min = np.minimum(self.min, lo)
+        self.max = np.maximum(self.max, hi)
+
+    def values(self):
+        # mean, std, min, max, rms (NaN for channels without samples)
+        ok = self.n>0
+        var = np.divide(self.m2, self.n, out=np.zeros(len(self.n)), where=ok)
+        nan = np.full(len(self.n), np.nan)
+        return (np.where(ok, self.mean, nan), np.where(ok, np.sqrt(var), nan),
+                np.where(ok, self.min, nan), np.where(ok, self.max, nan),
+                np.where(ok, np.sqrt(var+self.mean**2), nan))
+
+class WelchPSD():
+    # segments of nperseg samples overlapping by half, cut from the stream as
+    # it comes (the tail of a record is carried over to the next one, unless
+    # samples are missing in between), with the mean removed and a Hann window
+    def __init__(self, nchan, nperseg, fs):
+        self.nchan = nchan
+        self.nperseg = int(nperseg)
+        self.step = max(1, self.nperseg//2)
+        k = np.arange(self.nperseg)
+        self.window = 0.5-0.5*np.cos(2*np.pi*k/self.nperseg)
+        self.freq = np.fft.rfftfreq(self.nperseg, 1.0/fs)
+        # one-sided density, in V^2/Hz
+        self.scale = np.full(len(self.freq), 2.0/(fs*(self.window**2).sum()))
+        self.scale[0] = self.scale[0]/2
+        if self.nperseg%2==0:
+            self.scale[-1] = self.scale[-1]/2
+        self.reset(0)
+
+    def reset(self, index):
+        self.tail = np.zeros((self.nchan, 0))
+        self.first = index
+
+    def add(self, x, index):
+        # returns the last sample index of each new segment and their
+        # periodograms (nchan, nseg, nfreq)
+        if index!=self.first+self.tail.shape[1]:
+            self.reset(index)
+        ext = np.concatenate([self.tail, np.asarray(x, dtype=np.float64)], axis=1)
+        nseg = 0
+        if ext.shape[1]>=self.nperseg:
+            nseg = (ext.shape[1]-self.nperseg)//self.step+1
+        ends = self.first+self.step*np.arange(nseg)+self.nperseg-1
+        power = np.zeros((self.nchan, 0, len(self.freq)))
+        if nseg>0:
+            frames = np.lib.stride_tricks.sliding_window_view(ext, self.nperseg, axis=1)[:, ::self.step][:, :nseg]
+            frames = frames-frames.mean(axis=2, keepdims=True)
+            spec = np.fft.rfft(frames*self.window, axis=2)
+            power = spec.real**2+spec.imag**2
+        self.tail = ext[:, nseg*self.step:].copy()
+        self.first = self.first+nseg*self.step
+        return ends, power
+
+class Summarizer():
+    # statistics per record, and per bin of bin_samples samples counted from
+    # the start of the stream; a bin is complete once a later sample has been
+    # seen, and holds the PSD segments ending in it
+    def __init__(self, nchan, fs, bin_duration, nperseg=1024):
+        self.nchan = nchan
+        self.fs = fs
+        self.bin_samples = max(1, int(round(bin_duration*fs)))
+        self.psd = WelchPSD(nchan, nperseg, fs) if nperseg>1 else None
+        self.t0 = None
+        self.rows = []
+        self.bins = []
+        self.open = {}
+
+    def get_bin(self, b):
+        if not b in self.open:
+            nfreq = len(self.psd.freq) if self.psd is not None else 0
+            self.open[b] = (Moments(self.nchan), np.zeros((self.nchan, nfreq)), np.zeros(self.nchan))
+        return self.open[b]
+
+    def close_bins(self, before=None):
+        for b in sorted(self.open.keys()):
+            if before is not None and b>=before:
+                break
+            mom, psum, nseg = self.open.pop(b)
+            psd = np.zeros(psum.shape)
+            if self.psd is not None:
+                psd = psum*self.psd.scale/np.maximum(nseg, 1)[:, None]
+                psd[nseg==0] = np.nan
+            start = b*self.bin_samples
+            self.bins.append((start, self.t0+start/self.fs, int(mom.n.max()))+mom.values()+(psd, nseg))
+
+    def process(self, x, index, stamp):
+        if self.t0 is None:
+            self.t0 = stamp-index/self.fs
+        n = x.shape[1]
+        if n==0:
+            return
+        # moments, the record being cut at the bin boundaries
+        rec = Moments(self.nchan)
+        pos = 0
+        while pos<n:
+            b = (index+pos)//self.bin_samples
+            stop = min(n, (b+1)*self.bin_samples-index)
+            stats = block_stats(x[:, pos:stop])
+            rec.merge(stats)
+            self.get_bin(b)[0].merge(stats)
+            pos = stop
+        self.rows.append((index, stamp, n)+rec.values())
+
+        if self.psd is not None:
+            ends, power = self.psd.add(x, index)
+            if len(ends)>0:
+                ok = np.isfinite(power[:, :, 0])
+                power = np.where(ok[:, :, None], power, 0.0)
+                seg_bins = ends//self.bin_samples
+                for b in np.unique(seg_bins):
+                    sel = (seg_bins==b)
+                    mom, psum, nseg = self.get_bin(int(b))
+                    psum += power[:, sel].sum(axis=1)
+                    nseg += ok[:, sel].sum(axis=1)
+        self.close_bins((index+n-1)//self.bin_samples)
+
+    def take(self, last=None):
+        # rows of the records starting before sample last, and the bins
+        # complete by then; everything if last is None
+        if last is None:
+            self.close_bins()
+            rows, bins = self.rows, self.bins
+            self.rows, self.bins = [], []
+            return rows, bins
+        rows = [r for r in self.rows if r[0]<last]
+        self.rows = self.rows[len(rows):]
+        bins = [b for b in self.bins if b[0]+self.bin_samples<=last]
+        self.bins = self.bins[len(bins):]
+        return rows, bins
+
+def write_table(grp, items, nchan, with_psd=None):
+    grp.create_dataset("sample", data=np.array([it[0] for it in items], dtype='int64'))
+    grp.create_dataset("time", data=np.array([it[1] for it in items], dtype='float64'))
+    grp.create_dataset("length", data=np.array([it[2] for it in items], dtype='int64'))
+    for k, field in enumerate(SUMMARY_FIELDS):
+        vals = np.array([it[3+k] for it in items], dtype='float32').reshape(len(items), nchan)
+        grp.create_dataset(field, data=vals)
+    if with_psd is not None:
+        psd = np.array([it[8] for it in items], dtype='float32').reshape(len(items), nchan, with_psd)
+        grp.create_dataset("psd", data=psd, compression="gzip", shuffle=True)
+        grp.create_dataset("segments", data=np.array([it[9] for it in items], dtype='int32').reshape(len(items), nchan))
+
+def write_summary(fname, rows, bins, summarizer, info):
+    name = os.path.splitext(fname)[0]+"_summary.hdf5"
+    nchan = summarizer.nchan
+    with h5py.File(name, 'w') as f:
+        for key, val in info.items():
+            f.attrs[key] = val
+        f.attrs["Source_file"] = os.path.basename(fname)
+        f.attrs["Bin_samples"] = summarizer.bin_samples
+        f.attrs["Bin_duration"] = summarizer.bin_samples/summarizer.fs
+        nfreq = None
+        if summarizer.psd is not None:
+            nfreq = len(summarizer.psd.freq)
+            f.attrs["PSD_segment"] = summarizer.psd.nperseg
+            f.create_dataset("freq", data=summarizer.psd.freq)
+        write_table(f.create_group("Records"), rows, nchan)
+        write_table(f.create_group("Bins"), bins, nchan, nfreq)
+    return name
+
+class SummaryStage():
+    # Worker thread updating the summarizer with the records held in the ring
+    # of buffers. end_file(fname, last) is queued by the writer when an output
+    # file ends at sample last: the records queued before it include all
+    # those of the file, whose summary is then written.
+    def __init__(self, summarizer, info):
+        self.summarizer = summarizer
+        self.info = info
+        self.queue = queue.Queue()
+        self.th = None
+        self.error = None
+
+    def start(self):
+        self.th = threading.Thread(target=self.run)
+        self.th.start()
+
+    def submit(self, data, release, stamp, index):
+        self.queue.put(("record", data, release, stamp, index))
+
+    def end_file(self, fname, last=None):
+        self.queue.put(("file", fname, last))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            release = None
+            try:
+                if item[0]=="file":
+                    rows, bins = self.summarizer.take(item[2])
+                    write_summary(item[1], rows, bins, self.summarizer, self.info)
+                else:
+                    data, release, stamp, index = item[1:]
+                    self.summarizer.process(data, index, stamp)
+            except Exception as e:
+                if self.error is None:
+                    print("Summary error:", e)
+                self.error = e
+            if release is not None:
+                release()
+
+    def close(self):
+        if self.th is not None:
+            self.queue.put(None)
+            self.th.join()
+            self.th = None
@@ -0,0 +1,62 @@
+import os
+import h5py
+import numpy as np
+import pytest
+import simulator
+from engine import StreamEngine
+from reader import open_stream
+
+@pytest.mark.parametrize("fileext,layout", [(".hdf5", "chunks"), (".hdf5", "append"), (".bin", "chunks")])
+def test_rotation_with_postcompression(tmp_path, fileext, layout):
+    # records are written as fast as possible with the time stamps they
+    # would have in a real run (0.3 s files of 15 records), and every file
+    # is compressed by the worker processes while the next ones are written
+    simulator.configure(n_instr=1)
+    engine = StreamEngine(simulator)
+    engine.open_dev()
+    engine.chan_enabled = [1, 1, 0, 0]+[0]*12
+    engine.freq = 1e6
+    engine.res = 14
+    engine.reclength = 20000
+    engine.foldername = str(tmp_path)
+    engine.fileext = fileext
+    engine.h5layout = layout
+    engine.newfileperiod = 0.3
+    engine.newfileunit = "s"
+    engine.postcompression = "gzip"
+    engine.compressworkers = 2
+    engine.arm_dev()
+    okchans = engine.chan_indices()
+    engine.scp.make_pool()
+    pool = [np.array([engine.scp.pool[c][k] for c in okchans]) for k in range(len(engine.scp.pool[0]))]
+
+    nrec = 100
+    engine.init_output(okchans, start=0.0)
+    for count in range(nrec):
+        engine.write_chunk(pool[count%len(pool)], count, count*engine.reclength/engine.freq)
+    engine.close_output()
+
+    # all files compressed, and none left behind
+    files = os.listdir(str(tmp_path))
+    if fileext==".hdf5":
+        names = sorted([fn for fn in files if fn.endswith(".hdf5")])
+    else:
+        assert not any([fn.endswith(".bin") for fn in files])
+        names = sorted([fn for fn in files if fn.endswith(".binz")])
+    assert len(names)==engine.fcount+1 and len(names)==7
+    if fileext==".hdf5":
+        total = 0
+        for fn in names:
+            with h5py.File(os.path.join(str(tmp_path), fn), 'r') as f:
+                assert "Date" in f["Info"].attrs
+                assert f["Index/sample"].compression=="gzip"
+                total = total+len(f["Index/sample"])
+        assert total==nrec
+
+    r = open_stream(str(tmp_path))
+    n = int(r.ends.max())
+    assert n==nrec*engine.reclength
+    expected = np.concatenate([pool[k%len(pool)] for k in range(nrec)], axis=1)
+    for k in range(expected.shape[0]):
+        assert np.array_equal(r.read_samples(k, 0, n), expected[k])
+    r.close()
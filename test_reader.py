@@ -0,0 +1,51 @@
+import h5py
+import numpy as np
+import pytest
+from formats import to_counts
+from reader import open_stream, volts
+
+def legacy_file(fname, first, nrec, reclength=100, start_time=None):
+    # chunks layout written before the per-record index existed
+    with h5py.File(fname, 'w') as f:
+        info = f.create_group("Info")
+        info.attrs["Sampling_freq"] = 1000.0
+        info.attrs["First_sample"] = first
+        info.attrs["chan01"] = "Chan_1"
+        if start_time is not None:
+            info.attrs["Start_time"] = start_time
+        for k in range(nrec):
+            grp = f.create_group("chunk_"+str(k).rjust(8, '0'))
+            grp.create_dataset("chan01", data=np.arange(first+k*reclength, first+(k+1)*reclength, dtype='float32'))
+
+def test_files_without_records_are_skipped(tmp_path):
+    legacy_file(str(tmp_path/"datastream000000.hdf5"), 0, 3)
+    legacy_file(str(tmp_path/"datastream000001.hdf5"), 300, 0)
+    legacy_file(str(tmp_path/"datastream000002.hdf5"), 300, 2)
+    s = open_stream(str(tmp_path))
+    assert len(s.files)==2
+    assert s.n_samples==500
+    assert np.array_equal(s.read_samples(0, 0, 500), np.arange(500, dtype='float32'))
+    assert np.array_equal(s.read(0, 0.1, 0.2), np.arange(100, 200, dtype='float32'))
+    with pytest.raises(ValueError):
+        s.read(0, 0.1, 0.2, absolute=True)
+    s.close()
+
+def test_empty_folder_file(tmp_path):
+    legacy_file(str(tmp_path/"datastream.hdf5"), 0, 0)
+    s = open_stream(str(tmp_path))
+    assert len(s.files)==0 and s.n_samples==0
+    s.close()
+
+def test_missing_samples_stored_as_counts_read_as_nan(tmp_path):
+    # a record missing from one device of a MultiScope is NaN in volts
+    gain = 2.0*8.0/2**16
+    x = np.array([[np.nan, np.nan, 0.5, -8.0, 8.0-gain]])
+    codes = to_counts(x, [gain], [0.0], 'int16')
+    assert codes[0, 0]!=codes[0, 3]
+    with h5py.File(str(tmp_path / "c.hdf5"), 'w') as f:
+        dset = f.create_dataset("Chan_1", data=codes[0])
+        dset.attrs["Gain"] = gain
+        dset.attrs["Offset"] = 0.0
+        v = volts(dset)[:]
+    assert np.isnan(v[:2]).all()
+    assert np.array_equal(v[2:], np.array([0.5, -8.0+gain, 8.0-gain], dtype=np.float32))
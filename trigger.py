@@ -0,0 +1,182 @@
+import datetime
+import numpy as np
+
+# Event-triggered capture: detectors are evaluated on whole records, and only
+# the samples around detections (pre- and post-trigger) are passed on to the
+# writer. Each event is also listed in a catalogue (csv file).
+
+TRIGGER_LIST = ["none", "threshold", "stalta"]
+
+class ThresholdDetector():
+    # triggers on samples whose absolute value reaches level (V)
+    def __init__(self, nchan, level):
+        self.level = level
+
+    def reset(self):
+        pass
+
+    def detect(self, x):
+        v = np.abs(x).max(axis=0)
+        return v>=self.level, v
+
+class StaLtaDetector():
+    # triggers when the ratio of short-term to long-term average energy
+    # reaches level; the averages are moving windows of nsta and nlta
+    # samples, carried over from one record to the next
+    def __init__(self, nchan, level, nsta, nlta):
+        self.nchan = nchan
+        self.level = level
+        self.nsta = max(1, int(nsta))
+        self.nlta = max(self.nsta+1, int(nlta))
+        self.reset()
+
+    def reset(self):
+        self.tail = np.zeros((self.nchan, self.nlta))
+        self.n_seen = 0
+
+    def detect(self, x):
+        n = x.shape[1]
+        L = self.nlta
+        ext = np.concatenate([self.tail, np.asarray(x, dtype=np.float64)**2], axis=1)
+        c = np.zeros((self.nchan, ext.shape[1]+1))
+        np.cumsum(ext, axis=1, out=c[:, 1:])
+        p = np.arange(L, L+n)+1
+        sta = (c[:, p]-c[:, p-self.nsta])/self.nsta
+        lta = (c[:, p]-c[:, p-L])/L
+        ratio = (sta/np.maximum(lta, 1e-30)).max(axis=0)
+        # no detection until the long-term window is full
+        valid = self.n_seen+np.arange(n)+1 >= L
+        ratio[~valid] = 0.0
+        self.tail = ext[:, ext.shape[1]-L:]
+        self.n_seen = self.n_seen+n
+        return ratio>=self.level, ratio
+
+class TriggerStage():
+    # Called with each record (data[k] holding channel k, index the stream
+    # index of its first sample); windows of pre samples before and post
+    # samples after every detection, merged when they overlap, are passed to
+    # output(data, count, stamp, index, clock). The last pre samples are kept
+    # in a rolling buffer for the pre-trigger part.
+    def __init__(self, detector, chans, nchan, sample_rate, pre, post, output, catalogue=None, chan_names=None):
+        self.detector = detector
+        self.chans = chans
+        self.nchan = nchan
+        self.sample_rate = sample_rate
+        self.pre = max(0, int(pre))
+        self.post = max(1, int(post))
+        self.output = output
+        self.chan_names = chan_names
+        self.history = np.zeros((nchan, self.pre), dtype=np.float32)
+        self.n_history = 0
+        self.next_index = None
+        self.event = None
+        self.written = 0
+        self.n_events = 0
+        self.n_pieces = 0
+        self.n_samples = 0
+        self.n_kept = 0
+        self.cat = None
+        if catalogue is not None:
+            self.cat = open(catalogue, 'w', buffering=1)
+            self.cat.write("Event;Trigger sample;Trigger time;Date;Start sample;End sample;Duration (s);Peak (V);Peak channel;Detection"+"\n")
+
+    def reset(self, index):
+        # gap in the stream (dropped records): end the current event
+        if self.event is not None:
+            self.event["end"] = min(self.event["end"], self.written)
+            self.close_event()
+        self.detector.reset()
+        self.n_history = 0
+        self.written = index
+
+    def process(self, data, count, stamp, index, clock):
+        n = data.shape[1]
+        if index!=self.next_index:
+            self.reset(index)
+        self.next_index = index+n
+        self.n_samples = self.n_samples+n
+
+        mask, value = self.detector.detect(data[self.chans])
+        on = np.flatnonzero(mask)
+
+        # windows around the detections of this record, merged when closer
+        # than pre+post samples
+        windows = []
+        if len(on)>0:
+            cut = np.flatnonzero(np.diff(on)>self.pre+self.post)
+            first = np.concatenate([[0], cut+1])
+            last = np.concatenate([cut, [len(on)-1]])
+            for i, j in zip(first, last):
+                k = on[i]+np.argmax(value[on[i]:on[j]+1])
+                windows.append((int(index+on[i]-self.pre), int(index+on[j]+self.post), int(index+on[i]), float(value[k])))
+
+        for a, b, trig, val in windows:
+            if self.event is not None and a<=self.event["end"]:
+                self.event["end"] = max(self.event["end"], b)
+                self.event["detection"] = max(self.event["detection"], val)
+            else:
+                if self.event is not None:
+                    self.emit(data, count, stamp, index, clock)
+                    self.close_event()
+                self.n_events = self.n_events+1
+                self.event = {"number": self.n_events, "trigger": trig,
+                              "time": float(stamp+(trig-index)/self.sample_rate),
+                              "start": max(a, self.written, index-self.n_history), "end": b,
+                              "detection": val, "peak": 0.0, "peak_chan": 0}
+        if self.event is not None:
+            self.emit(data, count, stamp, index, clock)
+            if self.event["end"]<=index+n:
+                self.close_event()
+        self.keep_history(data)
+
+    def emit(self, data, count, stamp, index, clock):
+        # write the samples of the current event up to the end of the record
+        n = data.shape[1]
+        a = max(self.event["start"], self.written, index-self.n_history)
+        b = min(self.event["end"], index+n)
+        if b<=a:
+            return
+        if a<index:
+            piece = np.concatenate([self.history[:, self.pre-(index-a):], data[:, :b-index]], axis=1)
+        else:
+            piece = data[:, a-index:b-index]
+        peak = np.abs(piece).max(axis=1)
+        k = int(np.argmax(peak))
+        if peak[k]>self.event["peak"]:
+            self.event["peak"] = float(peak[k])
+            self.event["peak_chan"] = k
+        self.output(piece, self.n_pieces, stamp+(a-index)/self.sample_rate, a, clock)
+        self.n_pieces = self.n_pieces+1
+        self.n_kept = self.n_kept+(b-a)
+        self.written = b
+
+    def close_event(self):
+        ev = self.event
+        self.event = None
+        ev["end"] = min(ev["end"], self.written)
+        if self.cat is not None:
+            name = self.chan_names[ev["peak_chan"]] if self.chan_names else str(ev["peak_chan"])
+            row = [ev["number"], ev["trigger"], repr(ev["time"]), str(datetime.datetime.fromtimestamp(ev["time"])),
+                   ev["start"], ev["end"], (ev["end"]-ev["start"])/self.sample_rate,
+                   ev["peak"], name, ev["detection"]]
+            self.cat.write(";".join([str(v) for v in row])+"\n")
+
+    def keep_history(self, data):
+        if self.pre==0:
+            return
+        n = data.shape[1]
+        if n>=self.pre:
+            self.history[:] = data[:, n-self.pre:]
+        else:
+            self.history[:, :self.pre-n] = self.history[:, n:]
+            self.history[:, self.pre-n:] = data
+        self.n_history = min(self.pre, self.n_history+n)
+
+    def close(self):
+        if self.event is not None:
+            self.close_event()
+        if self.cat is not None:
+            self.cat.close()
+            self.cat = None
+        if self.n_samples>0:
+            print("Events:", self.n_events, " samples kept:", str(round(100.0*self.n_kept/self.n_samples, 3))+"%")